@@ -0,0 +1,323 @@
+"""
+Офлайн-бенчмарк цикла опроса без обращения к настоящему Telegram.
+
+FakeTelegramClient подменяет TelegramClient (и пользовательский клиент, и бота)
+и генерирует синтетический список участников с заданным оттоком и задержкой
+на каждый API-запрос. Бенчмарк выполняет /setchannel, затем несколько циклов
+poll_channel_once (тело цикла polling_task) и печатает по каждому размеру канала
+время, пиковый RSS, число API-запросов и коммитов базы на цикл.
+
+Пример:
+    python benchmark.py --sizes 10000,100000,1000000 --cycles 5 --churn 0.001
+    python benchmark.py --sizes 100000 --env ROSTER_MODE=compact --env TRACKING_MODE=full
+
+Каждый размер запускается в отдельном процессе, чтобы пиковый RSS не смешивался.
+Настройки main.py передаются через --env (они читаются при импорте модуля).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from telethon import functions, types
+from telethon.helpers import TotalList
+
+# Ограничение одной выдачи участников в Telegram
+API_WINDOW = 10000
+# Размер одного запроса GetParticipantsRequest в Telethon
+API_CHUNK = 200
+ALPHABET = "abcdefghijklmnopqrstuvwxyz"
+
+BENCH_CHANNEL_ID = -1001000000001
+
+
+def fake_first_name(uid):
+    """Детерминированное «имя» из латинских букв для поисковых шардов."""
+    name = []
+    for _ in range(6):
+        uid, rest = divmod(uid * 2654435761 % (1 << 61), 26)
+        name.append(ALPHABET[rest])
+    return "".join(name)
+
+
+def fake_user(uid):
+    """Синтетический пользователь с детерминированным профилем."""
+    return types.User(id=uid, first_name=fake_first_name(uid),
+                      username=f"user{uid}" if uid % 2 else None)
+
+
+class FakeTelegramClient:
+    """
+    Внутрипроцессная замена TelegramClient для бенчмарка: хранит список
+    участников канала, имитирует задержку и ограничение выдачи API,
+    считает запросы и отправленные сообщения.
+    """
+
+    def __init__(self, size, latency=0.0, seed=0):
+        self.latency = latency
+        self.random = random.Random(seed)
+        # id -> None; порядок вставки = порядок вступления
+        self.members = {}
+        # Первая буква имени -> {id: None}, чтобы поисковые шарды не перебирали всех
+        self.by_initial = {char: {} for char in ALPHABET}
+        self.next_id = 1
+        self._add_members(size)
+        self.api_calls = 0
+        self.sent_messages = 0
+
+    async def _request(self):
+        self.api_calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def _add_members(self, count):
+        for uid in range(self.next_id, self.next_id + count):
+            self.members[uid] = None
+            self.by_initial[fake_first_name(uid)[0]][uid] = None
+        self.next_id += count
+
+    def churn(self, count):
+        """Удаляет count случайных участников и добавляет count новых."""
+        leaving = self.random.sample(list(self.members), min(count, len(self.members)))
+        for uid in leaving:
+            del self.members[uid]
+            del self.by_initial[fake_first_name(uid)[0]][uid]
+        self._add_members(count)
+
+    # --- Подключение и события -------------------------------------------------
+
+    def is_connected(self):
+        return True
+
+    async def is_user_authorized(self):
+        return True
+
+    def add_event_handler(self, callback, event=None):
+        pass
+
+    # --- Сущности --------------------------------------------------------------
+
+    async def get_entity(self, entity):
+        await self._request()
+        if isinstance(entity, list):
+            return [fake_user(uid) for uid in entity]
+        return types.Channel(id=abs(entity) % 10 ** 10, title="Benchmark channel",
+                             photo=types.ChatPhotoEmpty(), date=None,
+                             username="bench_channel", broadcast=True)
+
+    async def get_input_entity(self, entity):
+        return types.InputChannel(channel_id=abs(entity) % 10 ** 10, access_hash=0)
+
+    # --- Участники -------------------------------------------------------------
+
+    def _select(self, search, filter):
+        if isinstance(filter, types.ChannelParticipantsRecent):
+            return reversed(self.members)
+        if isinstance(filter, (types.ChannelParticipantsAdmins, types.ChannelParticipantsBots)):
+            return iter(())
+        if search:
+            bucket = self.by_initial.get(search[0], {})
+            if len(search) == 1:
+                return iter(bucket)
+            return (uid for uid in bucket if fake_first_name(uid).startswith(search))
+        return iter(self.members)
+
+    async def iter_participants(self, entity, limit=None, *, search='', filter=None, aggressive=False):
+        selected = self._select(search, filter)
+        window = API_WINDOW if limit is None else min(limit, API_WINDOW)
+        returned = 0
+        while returned < window:
+            await self._request()
+            chunk = [uid for _, uid in zip(range(min(API_CHUNK, window - returned)), selected)]
+            for uid in chunk:
+                yield fake_user(uid)
+            returned += len(chunk)
+            if len(chunk) < API_CHUNK:
+                break
+
+    async def get_participants(self, entity, limit=None, **kwargs):
+        result = TotalList()
+        result.total = len(self.members)
+        if limit == 0:
+            await self._request()
+            return result
+        async for user in self.iter_participants(entity, limit, **kwargs):
+            result.append(user)
+        return result
+
+    # --- Сырые запросы ---------------------------------------------------------
+
+    async def __call__(self, request):
+        await self._request()
+        if isinstance(request, functions.channels.GetFullChannelRequest):
+            full_chat = types.ChannelFull(
+                id=request.channel.channel_id, about="", read_inbox_max_id=0,
+                read_outbox_max_id=0, unread_count=0, chat_photo=types.PhotoEmpty(id=0),
+                notify_settings=types.PeerNotifySettings(), bot_info=[], pts=0,
+                participants_count=len(self.members))
+            return types.messages.ChatFull(full_chat=full_chat, chats=[], users=[])
+        if isinstance(request, functions.channels.GetParticipantsRequest):
+            ids = [uid for _, uid in zip(range(request.limit),
+                                          self._select('', request.filter))]
+            return types.channels.ChannelParticipants(
+                count=len(self.members),
+                participants=[types.ChannelParticipant(user_id=uid, date=None) for uid in ids],
+                chats=[], users=[fake_user(uid) for uid in ids])
+        if isinstance(request, functions.channels.GetAdminLogRequest):
+            return types.channels.AdminLogResults(events=[], chats=[], users=[])
+        raise NotImplementedError(type(request).__name__)
+
+    # --- Бот -------------------------------------------------------------------
+
+    async def send_message(self, entity, message, **kwargs):
+        await self._request()
+        self.sent_messages += 1
+
+    async def disconnect(self):
+        pass
+
+
+class FakeEvent:
+    """Минимальная замена события NewMessage для вызова команд бота."""
+
+    def __init__(self, chat_id, match):
+        self.chat_id = chat_id
+        self.pattern_match = match
+        self.responses = []
+
+    async def respond(self, text, **kwargs):
+        self.responses.append(text)
+
+
+def peak_rss_mb():
+    """Пиковый RSS процесса в мегабайтах (ru_maxrss в Linux — в КБ)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def run_single(size, cycles, churn, latency):
+    """Прогон для одного размера канала внутри текущего процесса."""
+    import main
+
+    client = FakeTelegramClient(size, latency)
+    main.user_client = client
+    main.user_pool = main.ClientPool([client])
+    main.bot = client
+    main.ADMIN_CHAT_ID = 1
+    await main.init_db()
+    main.poll_semaphore = asyncio.Semaphore(main.MAX_CONCURRENT_POLLS)
+    main.notification_queue = asyncio.Queue()
+    main.notify_bucket = main.TokenBucket(1000, 1000)
+
+    commits = 0
+    original_commit = main.db.commit
+
+    async def counting_commit():
+        nonlocal commits
+        commits += 1
+        await original_commit()
+
+    main.db.commit = counting_commit
+
+    report = {'size': size, 'cycles': []}
+
+    event = FakeEvent(main.ADMIN_CHAT_ID,
+                      re.match(r'^/setchannel\s+(\-?\d+)(?:\s+(\d+))?$',
+                                    f"/setchannel {BENCH_CHANNEL_ID}"))
+    started = time.perf_counter()
+    await main.cmd_setchannel(event)
+    await main.import_tasks[BENCH_CHANNEL_ID]
+    main.stop_channel_polling(BENCH_CHANNEL_ID)
+    report['setchannel'] = {
+        'wall_s': round(time.perf_counter() - started, 3),
+        'api_calls': client.api_calls,
+        'db_commits': commits,
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+
+    per_cycle_churn = int(size * churn)
+    for _ in range(cycles):
+        client.churn(per_cycle_churn)
+        client.api_calls = 0
+        commits = 0
+        queued_before = main.notification_queue.qsize()
+        started = time.perf_counter()
+        await main.poll_channel_once(BENCH_CHANNEL_ID)
+        report['cycles'].append({
+            'wall_s': round(time.perf_counter() - started, 3),
+            'api_calls': client.api_calls,
+            'db_commits': commits,
+            'notifications': main.notification_queue.qsize() - queued_before,
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+        })
+
+    index_size = len(main.subscriber_index[BENCH_CHANNEL_ID])
+    report['index_size'] = index_size
+    report['expected_size'] = len(client.members)
+    await main.db.close()
+    return report
+
+
+def print_report(report):
+    """Печатает отчёт одного прогона в виде таблицы."""
+    setchannel = report['setchannel']
+    print(f"\n== {report['size']} подписчиков "
+          f"(в индексе {report['index_size']}, ожидалось {report['expected_size']}) ==")
+    print(f"/setchannel: {setchannel['wall_s']} с, API {setchannel['api_calls']}, "
+          f"коммитов {setchannel['db_commits']}, пиковый RSS {setchannel['peak_rss_mb']} МБ")
+    print(f"{'цикл':>5} {'время, с':>9} {'API':>6} {'коммиты':>8} {'уведомл.':>9} {'RSS, МБ':>8}")
+    for number, cycle in enumerate(report['cycles'], 1):
+        print(f"{number:>5} {cycle['wall_s']:>9} {cycle['api_calls']:>6} {cycle['db_commits']:>8} "
+              f"{cycle['notifications']:>9} {cycle['peak_rss_mb']:>8}")
+
+
+def main_cli():
+    """Точка входа: запускает прогоны по размерам в отдельных процессах."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,100000",
+                        help="размеры канала через запятую")
+    parser.add_argument("--cycles", type=int, default=3, help="циклов опроса на размер")
+    parser.add_argument("--churn", type=float, default=0.001,
+                        help="доля подписчиков, меняющихся за цикл")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="задержка одного API-запроса, с")
+    parser.add_argument("--env", action="append", default=[],
+                        help="настройка main.py в виде KEY=VALUE (можно несколько)")
+    parser.add_argument("--json", action="store_true", help="печатать отчёт в JSON")
+    parser.add_argument("--single", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single is not None:
+        report = asyncio.run(run_single(args.single, args.cycles, args.churn, args.latency))
+        print(json.dumps(report))
+        return
+
+    reports = []
+    for size in (int(size) for size in args.sizes.split(",")):
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(os.environ,
+                       DATABASE_PATH=os.path.join(tmp, "bench.db"),
+                       NOTIFY_COALESCE_SECONDS="0")
+            env.update(item.split("=", 1) for item in args.env)
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--single", str(size),
+                 "--cycles", str(args.cycles), "--churn", str(args.churn),
+                 "--latency", str(args.latency)],
+                env=env, check=True, capture_output=True, text=True).stdout
+        report = json.loads(output.strip().splitlines()[-1])
+        reports.append(report)
+        if not args.json:
+            print_report(report)
+    if args.json:
+        print(json.dumps(reports, indent=2))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,14 +1,55 @@
+import argparse
 import asyncio
+import bisect
+import contextlib
+import csv
+import gzip
 import os
+import pathlib
+import tempfile
+import zlib
 import logging
 import aiosqlite
-from datetime import datetime, timezone
+from array import array
+from datetime import datetime, timedelta, timezone
 import signal
 import sys
+import time
 
-from telethon import TelegramClient, events, errors
+from telethon import TelegramClient, events, errors, functions, types, utils
 from dotenv import load_dotenv
 
+# Необязательные тяжёлые зависимости импортируются при первом обращении
+# (load_numpy, load_pyarrow), чтобы не замедлять запуск бота
+np = None
+pa = pq = None
+loaded_optional_modules = set()
+
+
+def load_numpy():
+    """Возвращает модуль numpy или None; без него используется чистый Python."""
+    global np
+    if "numpy" not in loaded_optional_modules:
+        loaded_optional_modules.add("numpy")
+        try:
+            import numpy as np
+        except ImportError:
+            np = None
+    return np
+
+
+def load_pyarrow():
+    """Возвращает модуль pyarrow или None; без него экспорт только в CSV."""
+    global pa, pq
+    if "pyarrow" not in loaded_optional_modules:
+        loaded_optional_modules.add("pyarrow")
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            pa = pq = None
+    return pa
+
 # Загружаем .env
 load_dotenv()
 
@@ -33,43 +74,369 @@ ADMIN_CHAT_ID = int(os.getenv("TG_ADMIN_CHAT_ID", "0"))
 # Названия (или пути к) файлов/строк-сессий
 SESSION_NAME_USER = os.getenv("TG_USER_SESSION_NAME", "user_account.session")
 SESSION_NAME_BOT = os.getenv("TG_BOT_SESSION_NAME", "bot_account.session")
+# Пул пользовательских аккаунтов: имена сессий через запятую (по умолчанию
+# один TG_USER_SESSION_NAME). Первый аккаунт — основной: через него читаются
+# журнал действий и обновления канала. Аккаунты, добавленные через /login new,
+# хранятся в таблице user_sessions.
+USER_SESSION_NAMES = [name.strip() for name in os.getenv(
+    "TG_USER_SESSION_NAMES", SESSION_NAME_USER).split(",") if name.strip()]
 
 # Настройки polling
 POLLING_INTERVAL_SECONDS = int(
     os.getenv("POLLING_INTERVAL_SECONDS", "60"))  # Интервал в секундах
+# Режим отслеживания: "full" — полный diff списка подписчиков каждый цикл,
+# "incremental" — обновления канала + журнал действий администраторов
+TRACKING_MODE = os.getenv("TRACKING_MODE", "full").lower()
+# Как часто в режиме incremental выполнять полную сверку списка участников
+# (в режиме full — как долго предварительная проверка может пропускать загрузку)
+RECONCILE_INTERVAL_SECONDS = int(
+    os.getenv("RECONCILE_INTERVAL_SECONDS", "3600"))
+# Предварительная проверка перед полной загрузкой списка участников:
+# "off" — выключена, "count" — сравнивать participants_count,
+# "count_hash" — ещё и хэш первой страницы недавних участников
+PRECHECK_MODE = os.getenv("PRECHECK_MODE", "count_hash").lower()
+# Размер страницы недавних участников для хэша
+PRECHECK_RECENT_LIMIT = int(os.getenv("PRECHECK_RECENT_LIMIT", "50"))
+# Представление списка подписчиков в памяти: "dict" — id и профили,
+# "compact" — только отсортированный массив id (8 байт на подписчика)
+ROSTER_MODE = os.getenv("ROSTER_MODE", "dict").lower()
+# Размер страницы при потоковой загрузке участников
+PARTICIPANTS_PAGE_SIZE = int(os.getenv("PARTICIPANTS_PAGE_SIZE", "200"))
+# Загрузка полного списка участников: "simple" — один запрос iter_participants,
+# "sharded" — параллельно по поисковым шардам, "auto" — шарды для каналов
+# больше SHARDED_FETCH_THRESHOLD подписчиков (одна выдача ограничена ~10k)
+ROSTER_FETCH_MODE = os.getenv("ROSTER_FETCH_MODE", "auto").lower()
+SHARDED_FETCH_THRESHOLD = int(os.getenv("SHARDED_FETCH_THRESHOLD", "9000"))
+SHARD_CONCURRENCY = int(os.getenv("SHARD_CONCURRENCY", "3"))
+# Символы для поисковых шардов и дробление шардов, упёршихся в лимит выдачи
+SHARD_ALPHABET = os.getenv(
+    "SHARD_ALPHABET", "abcdefghijklmnopqrstuvwxyz0123456789абвгдеёжзийклмнопрстуфхцчшщэюя")
+SHARD_REFINE_THRESHOLD = int(os.getenv("SHARD_REFINE_THRESHOLD", "9000"))
+SHARD_MAX_PREFIX_LENGTH = int(os.getenv("SHARD_MAX_PREFIX_LENGTH", "3"))
+# Допустимая недостача участников при шардированной сверке относительно
+# participants_count канала: доля и абсолютный минимум (удалённые и скрытые
+# аккаунты учитываются в счётчике, но не выдаются списком). Если недостача
+# больше (символы вне SHARD_ALPHABET, шарды, упёршиеся в лимит выдачи),
+# отписки в этом цикле не записываются
+ROSTER_COVERAGE_TOLERANCE = float(os.getenv("ROSTER_COVERAGE_TOLERANCE", "0.001"))
+ROSTER_COVERAGE_MIN_MISSING = int(os.getenv("ROSTER_COVERAGE_MIN_MISSING", "10"))
+# Адаптивный интервал опроса: после цикла с изменениями интервал уменьшается
+# вдвое, после пустого — увеличивается в POLL_BACKOFF_FACTOR раз, в пределах
+# [POLL_INTERVAL_MIN, POLL_INTERVAL_MAX]; FloodWait тоже увеличивает интервал
+ADAPTIVE_POLLING = os.getenv(
+    "ADAPTIVE_POLLING", "false").lower() in ("1", "true", "yes")
+POLL_INTERVAL_MIN = int(os.getenv("POLL_INTERVAL_MIN", "15"))
+POLL_INTERVAL_MAX = int(os.getenv("POLL_INTERVAL_MAX", "900"))
+POLL_BACKOFF_FACTOR = float(os.getenv("POLL_BACKOFF_FACTOR", "2"))
+# Сколько секунд метаданные канала (название, username, число подписчиков)
+# отдаются из кэша без обращения к Telegram
+CHANNEL_METADATA_TTL = int(os.getenv("CHANNEL_METADATA_TTL", "300"))
+# Контрольная точка состава канала (сжатый список id) сохраняется раз
+# в CHECKPOINT_EVERY_CYCLES циклов опроса (0 — только после начального импорта)
+CHECKPOINT_EVERY_CYCLES = int(os.getenv("CHECKPOINT_EVERY_CYCLES", "1440"))
+# Начальный импорт подписчиков в /setchannel: строк на один INSERT
+# и период сообщений о ходе импорта
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "5000"))
+IMPORT_PROGRESS_SECONDS = int(os.getenv("IMPORT_PROGRESS_SECONDS", "15"))
+# Экспорт истории действий: формат (auto|csv|parquet; auto — parquet при наличии
+# pyarrow) и число строк, читаемых из базы за один раз
+EXPORT_FORMAT = os.getenv("EXPORT_FORMAT", "auto")
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "5000"))
+# Изменения профилей подписчиков (username, имя, фамилия) при полной сверке:
+# off — не отслеживать, update — обновлять строки subscribers,
+# log — дополнительно записывать действие PROFILE_CHANGED
+PROFILE_TRACKING = os.getenv("PROFILE_TRACKING", "update")
+# Сколько каналов может опрашиваться одновременно
+MAX_CONCURRENT_POLLS = int(os.getenv("MAX_CONCURRENT_POLLS", "4"))
+# Отправка уведомлений: не больше NOTIFY_RATE_PER_SECOND сообщений в секунду
+# (до NOTIFY_BURST подряд), события собираются за NOTIFY_COALESCE_SECONDS,
+# и если по каналу их больше NOTIFY_DIGEST_THRESHOLD — отправляется одна сводка
+NOTIFY_RATE_PER_SECOND = float(os.getenv("NOTIFY_RATE_PER_SECOND", "1"))
+NOTIFY_BURST = int(os.getenv("NOTIFY_BURST", "5"))
+NOTIFY_COALESCE_SECONDS = float(os.getenv("NOTIFY_COALESCE_SECONDS", "2"))
+NOTIFY_DIGEST_THRESHOLD = int(os.getenv("NOTIFY_DIGEST_THRESHOLD", "10"))
+NOTIFY_DIGEST_MAX_PAGES = int(os.getenv("NOTIFY_DIGEST_MAX_PAGES", "5"))
+NOTIFY_MAX_RETRIES = int(os.getenv("NOTIFY_MAX_RETRIES", "5"))
+# Подавление «мерцаний»: уведомление удерживается NOTIFY_DEBOUNCE_SECONDS,
+# и если за это время тот же пользователь совершил обратное действие
+# (подписка и отписка или наоборот), оба уведомления отменяются (0 — выключено).
+# Записи в actions при этом сохраняются.
+NOTIFY_DEBOUNCE_SECONDS = float(os.getenv("NOTIFY_DEBOUNCE_SECONDS", "0"))
+# Адрес HTTP-эндпоинта метрик в формате Prometheus (METRICS_PORT=0 — выключен)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
 # Путь к SQLite базе данных
 DATABASE_PATH = os.getenv("DATABASE_PATH", "telegram_bot.db")
+# Включить WAL-журнал и synchronous=NORMAL (меньше fsync на каждую запись)
+DATABASE_WAL_MODE = os.getenv(
+    "DATABASE_WAL_MODE", "false").lower() in ("1", "true", "yes")
+# Хранение истории: действия старше ACTIONS_RETENTION_DAYS суток (0 — хранить всё)
+# раз в RETENTION_INTERVAL_SECONDS архивируются в помесячные gzip-CSV в ARCHIVE_DIR
+# и удаляются пачками по RETENTION_BATCH_SIZE; счётчики /stats при этом сохраняются.
+# Освободившиеся страницы возвращаются incremental vacuum по VACUUM_STEP_PAGES за шаг.
+ACTIONS_RETENTION_DAYS = int(os.getenv("ACTIONS_RETENTION_DAYS", "0"))
+RETENTION_INTERVAL_SECONDS = int(os.getenv("RETENTION_INTERVAL_SECONDS", "86400"))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "5000"))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+VACUUM_STEP_PAGES = int(os.getenv("VACUUM_STEP_PAGES", "1000"))
+# Запись всех обращений бота и аккаунтов к Telegram в файл (gzip, JSON Lines)
+# для воспроизведения через replay.py; пусто — запись выключена
+TG_RECORD_PATH = os.getenv("TG_RECORD_PATH", "")
 
 # Глобальные переменные
-user_client = None
+user_client = None  # Основной пользовательский аккаунт (первый в user_pool)
+user_pool = None  # ClientPool всех пользовательских аккаунтов
+traffic_recorder = None  # replay.TrafficRecorder, если задан TG_RECORD_PATH
 bot = None
-current_channel_id = None
 db = None  # Экземпляр базы данных aiosqlite
+# Транзакции на общем соединении db выполняются по одной (см. db_transaction)
+db_lock = None
+# Отслеживаемые каналы: tg_id -> информация о канале из таблицы channel
+tracked_channels = {}
+# Задачи опроса по каналам: tg_id -> asyncio.Task
+channel_tasks = {}
+# Задачи начального импорта подписчиков: tg_id -> asyncio.Task
+import_tasks = {}
+# Каналы, начальный импорт которых завершился ошибкой: tg_id -> текст ошибки
+failed_imports = {}
+poll_semaphore = None  # Ограничение числа одновременно опрашиваемых каналов
+# Изменения участников, пришедшие через обновления канала:
+# tg_id канала -> [(user_id, вступил ли), ...]
+pending_participant_updates = {}
+last_reconcile_at = {}  # tg_id канала -> time.monotonic() последней полной сверки
+# Текущий адаптивный интервал опроса: tg_id канала -> секунды
+poll_intervals = {}
+# Отпечаток списка участников на момент последней полной сверки:
+# tg_id канала -> (participants_count, хэш недавних участников)
+roster_fingerprints = {}
+# Циклы опроса с последней контрольной точки состава: tg_id канала -> число
+checkpoint_cycles = {}
+# Кэш метаданных каналов: tg_id -> {'title', 'username', 'participants_count', 'updated_at'}
+channel_metadata = {}
+notification_queue = None  # Очередь уведомлений для notification_task
+notify_bucket = None  # TokenBucket для отправки уведомлений
+# Удерживаемые уведомления: (tg_id канала, user_id) -> уведомление
+held_notifications = {}
+# Резидентный индекс подписчиков: tg_id канала -> {user_id: (username, first_name, last_name)}
+# или CompactSubscriberIndex. Загружается из базы один раз и обновляется вместе с записью в базу.
+subscriber_index = {}
+
+# ------------------------------------------------------------------------------
+# МЕТРИКИ
+# ------------------------------------------------------------------------------
+
+# Границы корзин гистограмм длительности, в секундах
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Все метрики в порядке объявления — для вывода в формате Prometheus
+METRICS = []
+
+
+def format_labels(labels):
+    """Форматирует метки в виде {name="value",...} для формата Prometheus."""
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class Counter:
+    """Монотонно растущий счётчик с метками."""
+    kind = "counter"
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.values = {}
+        METRICS.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, key, value
+
+
+class Gauge(Counter):
+    """Текущее значение с метками; может вычисляться при каждом чтении."""
+    kind = "gauge"
+
+    def __init__(self, name, description, function=None):
+        super().__init__(name, description)
+        self.function = function
+
+    def set(self, value, **labels):
+        self.values[tuple(sorted(labels.items()))] = value
+
+    def samples(self):
+        if self.function is not None:
+            yield self.name, (), self.function()
+        yield from super().samples()
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами, суммой и количеством наблюдений."""
+    kind = "histogram"
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.values = {}  # метки -> [счётчики корзин..., сумма, количество]
+        METRICS.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        state = self.values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[i] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Контекстный менеджер: записывает длительность блока."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def quantile(self, q, **labels):
+        """Приближённый квантиль по корзинам (верхняя граница корзины)."""
+        state = self.values.get(tuple(sorted(labels.items())))
+        if not state or not state[-1]:
+            return None
+        for bound, count in zip(self.buckets, state):
+            if count >= q * state[-1]:
+                return bound
+        return float("inf")
+
+    def samples(self):
+        for key, state in self.values.items():
+            for bound, count in zip(self.buckets, state):
+                yield f"{self.name}_bucket", key + (("le", bound),), count
+            yield f"{self.name}_bucket", key + (("le", "+Inf"),), state[-1]
+            yield f"{self.name}_sum", key, state[-2]
+            yield f"{self.name}_count", key, state[-1]
+
+
+def render_metrics():
+    """Все метрики в текстовом формате Prometheus."""
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+async def handle_metrics_request(reader, writer):
+    """Минимальный HTTP-обработчик: на любой GET отдаёт render_metrics()."""
+    try:
+        await reader.readuntil(b"\r\n\r\n")
+        body = render_metrics().encode()
+        writer.write(b"HTTP/1.1 200 OK\r\n"
+                     b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                     b"Connection: close\r\n\r\n" + body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server():
+    """Запускает HTTP-эндпоинт метрик, если задан METRICS_PORT."""
+    if not METRICS_PORT:
+        return None
+    server = await asyncio.start_server(handle_metrics_request, METRICS_HOST, METRICS_PORT)
+    logging.info(
+        f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return server
+
+
+POLL_CYCLE_SECONDS = Histogram(
+    "tracker_poll_cycle_seconds", "Длительность цикла опроса канала")
+POLL_FETCH_SECONDS = Histogram(
+    "tracker_poll_fetch_seconds", "Время загрузки данных из Telegram за цикл")
+POLL_DIFF_SECONDS = Histogram(
+    "tracker_poll_diff_seconds", "Время вычисления подписок и отписок за цикл")
+POLL_DB_WRITE_SECONDS = Histogram(
+    "tracker_poll_db_write_seconds", "Время записи результата цикла в базу")
+POLL_CYCLES = Counter(
+    "tracker_poll_cycles_total", "Циклы опроса по результату")
+SUBSCRIBER_CHANGES = Counter(
+    "tracker_subscriber_changes_total", "Зафиксированные подписки и отписки")
+POLL_INTERVAL = Gauge(
+    "tracker_poll_interval_seconds", "Текущий интервал опроса канала")
+ROSTER_SIZE = Gauge(
+    "tracker_roster_size", "Число подписчиков канала по последнему циклу")
+FLOOD_WAIT_SECONDS = Counter(
+    "tracker_flood_wait_seconds_total", "Суммарное время FloodWait по источнику")
+NOTIFICATIONS_SENT = Counter(
+    "tracker_notifications_sent_total", "Отправленные сообщения с уведомлениями")
+NOTIFICATIONS_SUPPRESSED = Counter(
+    "tracker_notifications_suppressed_total", "Уведомления, отменённые как мерцание")
+NOTIFICATION_QUEUE_DEPTH = Gauge(
+    "tracker_notification_queue_depth", "Уведомлений в очереди на отправку",
+    lambda: notification_queue.qsize() if notification_queue is not None else 0)
+ROSTER_INCOMPLETE = Counter(
+    "tracker_roster_incomplete_total", "Полные сверки, не покрывшие весь список участников")
+ACTIONS_ARCHIVED = Counter(
+    "tracker_actions_archived_total", "Действия, перенесённые из базы в архив")
+COMMAND_SECONDS = Histogram(
+    "tracker_command_seconds", "Длительность обработки команд бота")
 
 # ------------------------------------------------------------------------------
 # DATABASE HANDLING
 # ------------------------------------------------------------------------------
 
+# Таблицы счётчиков действий -> длина префикса time_utc, задающего интервал
+# ('2024-01-31T12' — час, '2024-01-31' — сутки)
+ROLLUP_TABLES = {"actions_hourly": 13, "actions_daily": 10}
 
 async def init_db():
     """Инициализирует базу данных и создаёт необходимые таблицы."""
-    global db
+    global db, db_lock
     db = await aiosqlite.connect(DATABASE_PATH)
+    db_lock = asyncio.Lock()
+    # Для новой базы режим задаётся до создания таблиц, для существующей
+    # вступает в силу только после VACUUM
+    await db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    async with db.execute("PRAGMA auto_vacuum") as cursor:
+        auto_vacuum = (await cursor.fetchone())[0]
+    if auto_vacuum != 2 and ACTIONS_RETENTION_DAYS:
+        logging.info("Перевод базы в режим auto_vacuum=INCREMENTAL (VACUUM)...")
+        await db.execute("VACUUM")
+    if DATABASE_WAL_MODE:
+        await db.execute("PRAGMA journal_mode=WAL")
+        await db.execute("PRAGMA synchronous=NORMAL")
     await db.execute("""
     CREATE TABLE IF NOT EXISTS channel (
         id INTEGER PRIMARY KEY,
         tg_id INTEGER UNIQUE,
         name TEXT,
-        username TEXT
+        username TEXT,
+        poll_interval INTEGER,
+        baseline_ready INTEGER DEFAULT 1
     )
     """)
 
+    await migrate_db()
+
     await db.execute("""
     CREATE TABLE IF NOT EXISTS subscribers (
-        user_tg_id INTEGER PRIMARY KEY,
+        channel_tg_id INTEGER,
+        user_tg_id INTEGER,
         username TEXT,
         first_name TEXT,
-        last_name TEXT
+        last_name TEXT,
+        fingerprint INTEGER,
+        PRIMARY KEY (channel_tg_id, user_tg_id)
     )
     """)
 
@@ -80,203 +447,2103 @@ async def init_db():
         user_tg_username TEXT,
         user_tg_name TEXT,
         user_tg_surname TEXT,
-        action TEXT CHECK(action IN ('SUBSCRIBED', 'UNSUBSCRIBED')),
+        action TEXT CHECK(action IN ('SUBSCRIBED', 'UNSUBSCRIBED', 'PROFILE_CHANGED')),
         time_utc TEXT,
         channel_tg_id INTEGER
     )
     """)
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_actions_channel_time ON actions (channel_tg_id, time_utc)")
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_actions_user ON actions (user_tg_id)")
+
+    # Почасовые и посуточные счётчики подписок и отписок для /stats,
+    # обновляются в log_actions в той же транзакции, что и запись в actions
+    rollups_exist = bool(await get_table_columns("actions_daily"))
+    for table in ROLLUP_TABLES:
+        await db.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            channel_tg_id INTEGER,
+            bucket TEXT,
+            subscribed INTEGER DEFAULT 0,
+            unsubscribed INTEGER DEFAULT 0,
+            PRIMARY KEY (channel_tg_id, bucket)
+        )
+        """)
+    if not rollups_exist:
+        await backfill_action_rollups()
 
+    # Контрольные точки состава каналов для восстановления на прошлую дату
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS roster_checkpoints (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        channel_tg_id INTEGER,
+        time_utc TEXT,
+        member_count INTEGER,
+        ids BLOB
+    )
+    """)
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_roster_checkpoints_channel_time "
+        "ON roster_checkpoints (channel_tg_id, time_utc)")
+
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS user_sessions (
+        session_name TEXT PRIMARY KEY
+    )
+    """)
+
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS tracking_state (
+        channel_tg_id INTEGER PRIMARY KEY,
+        admin_log_max_id INTEGER DEFAULT 0,
+        reconcile_time_utc TEXT,
+        precheck_count INTEGER,
+        precheck_hash INTEGER
+    )
+    """)
+
+    await db.commit()
+
+
+async def backfill_action_rollups():
+    """Заполняет таблицы счётчиков по уже накопленной истории actions."""
+    for table, length in ROLLUP_TABLES.items():
+        await db.execute(f"""
+        INSERT INTO {table} (channel_tg_id, bucket, subscribed, unsubscribed)
+        SELECT channel_tg_id, substr(time_utc, 1, {length}),
+               SUM(action = 'SUBSCRIBED'), SUM(action = 'UNSUBSCRIBED')
+        FROM actions
+        GROUP BY channel_tg_id, substr(time_utc, 1, {length})
+        """)
+
+
+async def get_table_columns(table):
+    """Возвращает список колонок таблицы (пустой, если таблицы нет)."""
+    async with db.execute(f"PRAGMA table_info({table})") as cursor:
+        rows = await cursor.fetchall()
+    return [row[1] for row in rows]
+
+
+async def migrate_db():
+    """Переводит базу со схемы с одним каналом на схему с несколькими каналами."""
+    if "poll_interval" not in await get_table_columns("channel"):
+        await db.execute("ALTER TABLE channel ADD COLUMN poll_interval INTEGER")
+    # Каналы, добавленные до фонового импорта, уже имеют полный начальный список
+    if "baseline_ready" not in await get_table_columns("channel"):
+        await db.execute("ALTER TABLE channel ADD COLUMN baseline_ready INTEGER DEFAULT 1")
+
+    # Контрольная точка цикла опроса для тёплого перезапуска
+    tracking_columns = await get_table_columns("tracking_state")
+    for column, column_type in (("reconcile_time_utc", "TEXT"), ("precheck_count", "INTEGER"),
+                                ("precheck_hash", "INTEGER")):
+        if tracking_columns and column not in tracking_columns:
+            await db.execute(f"ALTER TABLE tracking_state ADD COLUMN {column} {column_type}")
+
+    subscriber_columns = await get_table_columns("subscribers")
+    if subscriber_columns and "channel_tg_id" not in subscriber_columns:
+        logging.info("Миграция таблицы subscribers на схему с несколькими каналами...")
+        await db.execute("ALTER TABLE subscribers RENAME TO subscribers_old")
+        await db.execute("""
+        CREATE TABLE subscribers (
+            channel_tg_id INTEGER,
+            user_tg_id INTEGER,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            fingerprint INTEGER,
+            PRIMARY KEY (channel_tg_id, user_tg_id)
+        )
+        """)
+        # Раньше отслеживался только один канал — все подписчики относятся к нему
+        await db.execute("""
+        INSERT INTO subscribers (channel_tg_id, user_tg_id, username, first_name, last_name)
+        SELECT (SELECT tg_id FROM channel LIMIT 1), user_tg_id, username, first_name, last_name
+        FROM subscribers_old
+        WHERE EXISTS (SELECT 1 FROM channel)
+        """)
+        await db.execute("DROP TABLE subscribers_old")
+
+    # Отпечатки профилей подписчиков для отслеживания их изменений
+    subscriber_columns = await get_table_columns("subscribers")
+    if subscriber_columns and "fingerprint" not in subscriber_columns:
+        await db.execute("ALTER TABLE subscribers ADD COLUMN fingerprint INTEGER")
+    if subscriber_columns:
+        await backfill_subscriber_fingerprints()
+
+    # Ограничение CHECK нельзя изменить через ALTER TABLE — пересоздаём таблицу
+    async with db.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'actions'") as cursor:
+        row = await cursor.fetchone()
+    if row and "PROFILE_CHANGED" not in row[0]:
+        logging.info("Миграция таблицы actions: добавление действия PROFILE_CHANGED...")
+        await db.execute("ALTER TABLE actions RENAME TO actions_old")
+        await db.execute("""
+        CREATE TABLE actions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_tg_id INTEGER,
+            user_tg_username TEXT,
+            user_tg_name TEXT,
+            user_tg_surname TEXT,
+            action TEXT CHECK(action IN ('SUBSCRIBED', 'UNSUBSCRIBED', 'PROFILE_CHANGED')),
+            time_utc TEXT,
+            channel_tg_id INTEGER
+        )
+        """)
+        await db.execute("""
+        INSERT INTO actions (id, user_tg_id, user_tg_username, user_tg_name, user_tg_surname, action, time_utc, channel_tg_id)
+        SELECT id, user_tg_id, user_tg_username, user_tg_name, user_tg_surname, action, time_utc, channel_tg_id
+        FROM actions_old
+        """)
+        # Индексы удаляются вместе со старой таблицей и создаются заново в init_db
+        await db.execute("DROP TABLE actions_old")
     await db.commit()
 
 
-async def get_tracked_channel():
-    """Получает информацию о текущем отслеживаемом канале."""
-    async with db.execute("SELECT tg_id, name, username FROM channel LIMIT 1") as cursor:
+async def backfill_subscriber_fingerprints(batch_size=5000):
+    """Заполняет отпечатки профилей у строк subscribers, где их ещё нет."""
+    while True:
+        async with db.execute("""
+        SELECT channel_tg_id, user_tg_id, username, first_name, last_name FROM subscribers
+        WHERE fingerprint IS NULL LIMIT ?
+        """, (batch_size,)) as cursor:
+            rows = await cursor.fetchall()
+        if not rows:
+            break
+        await db.executemany("UPDATE subscribers SET fingerprint = ? WHERE channel_tg_id = ? AND user_tg_id = ?",
+                             [(profile_fingerprint(*row[2:]), row[0], row[1]) for row in rows])
+
+
+@contextlib.asynccontextmanager
+async def db_transaction(commit=True):
+    """
+    Транзакция на общем соединении db. Все задачи пишут через одно соединение,
+    поэтому транзакция держит db_lock до коммита, а при ошибке или отмене
+    задачи откатывается. commit=False — запросы выполняются внутри уже
+    открытой вызывающим кодом транзакции.
+    """
+    if not commit:
+        yield
+        return
+    async with db_lock:
+        try:
+            yield
+        except BaseException:
+            await db.rollback()
+            raise
+        await db.commit()
+
+
+def channel_from_row(row):
+    """Преобразует строку таблицы channel в словарь."""
+    return {'tg_id': row[0], 'name': row[1], 'username': row[2], 'poll_interval': row[3],
+            'baseline_ready': bool(row[4])}
+
+
+async def get_tracked_channels():
+    """Возвращает список всех отслеживаемых каналов."""
+    async with db.execute("SELECT tg_id, name, username, poll_interval, baseline_ready FROM channel ORDER BY id") as cursor:
+        rows = await cursor.fetchall()
+    return [channel_from_row(row) for row in rows]
+
+
+async def get_tracked_channel(channel_tg_id):
+    """Получает информацию об отслеживаемом канале."""
+    async with db.execute("SELECT tg_id, name, username, poll_interval, baseline_ready FROM channel WHERE tg_id = ?", (channel_tg_id,)) as cursor:
         row = await cursor.fetchone()
     if row:
-        return {'tg_id': row[0], 'name': row[1], 'username': row[2]}
+        return channel_from_row(row)
     return None
 
 
-async def set_tracked_channel(tg_id, name, username):
-    """Устанавливает отслеживаемый канал, очищает предыдущих подписчиков."""
-    await db.execute("DELETE FROM channel")
-    await db.execute("INSERT INTO channel (tg_id, name, username) VALUES (?, ?, ?)", (tg_id, name, username))
-    # Очистка предыдущих подписчиков
-    await db.execute("DELETE FROM subscribers")
-    await db.commit()
+async def set_tracked_channel(tg_id, name, username, poll_interval=None):
+    """
+    Добавляет канал в отслеживаемые (или обновляет его),
+    очищает сохранённых подписчиков этого канала.
+    Канал не опрашивается, пока не сохранён начальный список (mark_baseline_ready).
+    """
+    channel_metadata.pop(tg_id, None)
+    async with db_transaction():
+        await db.execute("""
+        INSERT INTO channel (tg_id, name, username, poll_interval, baseline_ready) VALUES (?, ?, ?, ?, 0)
+        ON CONFLICT(tg_id) DO UPDATE SET
+            name = excluded.name, username = excluded.username, poll_interval = excluded.poll_interval,
+            baseline_ready = 0
+        """, (tg_id, name, username, poll_interval))
+        # Очистка предыдущих подписчиков канала и курсора журнала действий
+        await db.execute("DELETE FROM subscribers WHERE channel_tg_id = ?", (tg_id,))
+        await db.execute("DELETE FROM tracking_state WHERE channel_tg_id = ?", (tg_id,))
+
+
+async def mark_baseline_ready(tg_id, commit=True):
+    """Отмечает, что начальный список подписчиков канала сохранён."""
+    async with db_transaction(commit):
+        await db.execute("UPDATE channel SET baseline_ready = 1 WHERE tg_id = ?", (tg_id,))
+
+
+async def remove_tracked_channel(tg_id):
+    """Прекращает отслеживание канала. История действий сохраняется."""
+    channel_metadata.pop(tg_id, None)
+    async with db_transaction():
+        await db.execute("DELETE FROM channel WHERE tg_id = ?", (tg_id,))
+        await db.execute("DELETE FROM subscribers WHERE channel_tg_id = ?", (tg_id,))
+        await db.execute("DELETE FROM tracking_state WHERE channel_tg_id = ?", (tg_id,))
+
+
+async def get_user_sessions():
+    """Возвращает имена сессий аккаунтов, добавленных через /login new."""
+    async with db.execute("SELECT session_name FROM user_sessions ORDER BY rowid") as cursor:
+        rows = await cursor.fetchall()
+    return [row[0] for row in rows]
 
 
-async def get_stored_subscribers():
-    """Возвращает список всех подписчиков из базы данных."""
-    async with db.execute("SELECT user_tg_id, username, first_name, last_name FROM subscribers") as cursor:
-        rows = await cursor.fetchall()
-    return {row[0]: {'username': row[1], 'first_name': row[2], 'last_name': row[3]} for row in rows}
+async def add_user_session(session_name):
+    """Запоминает сессию добавленного аккаунта."""
+    async with db_transaction():
+        await db.execute("INSERT OR IGNORE INTO user_sessions (session_name) VALUES (?)", (session_name,))
 
 
-async def add_subscriber(user):
-    """Добавляет нового подписчика в базу данных."""
-    await db.execute("""
-    INSERT OR IGNORE INTO subscribers (user_tg_id, username, first_name, last_name)
-    VALUES (?, ?, ?, ?)
-    """, (user.id, user.username, user.first_name, user.last_name))
-    await db.commit()
+async def remove_user_session(session_name):
+    """Забывает сессию аккаунта."""
+    async with db_transaction():
+        await db.execute("DELETE FROM user_sessions WHERE session_name = ?", (session_name,))
 
 
-async def remove_subscriber(user_tg_id):
-    """Удаляет подписчика из базы данных."""
-    await db.execute("DELETE FROM subscribers WHERE user_tg_id = ?", (user_tg_id,))
-    await db.commit()
+async def get_stored_subscribers(channel_tg_id):
+    """
+    Возвращает всех подписчиков канала из базы данных
+    в виде {user_id: (username, first_name, last_name)}.
+    """
+    async with db.execute("SELECT user_tg_id, username, first_name, last_name FROM subscribers WHERE channel_tg_id = ?", (channel_tg_id,)) as cursor:
+        rows = await cursor.fetchall()
+    return {row[0]: row[1:] for row in rows}
 
 
-async def log_action(user_tg_id, username, first_name, last_name, action, channel_tg_id):
-    """Логирует действие подписчика в таблицу actions."""
+async def get_stored_subscriber_fingerprints(channel_tg_id):
+    """
+    Возвращает отсортированный массив id подписчиков канала и выровненный
+    с ним массив отпечатков профилей.
+    """
+    ids, fingerprints = array('q'), array('I')
+    async with db.execute("SELECT user_tg_id, fingerprint FROM subscribers WHERE channel_tg_id = ? ORDER BY user_tg_id", (channel_tg_id,)) as cursor:
+        async for row in cursor:
+            ids.append(row[0])
+            fingerprints.append(row[1] or 0)
+    return ids, fingerprints
+
+
+async def get_subscriber_profiles(channel_tg_id, user_tg_ids, chunk_size=500):
+    """Возвращает {user_id: (username, first_name, last_name)} для указанных подписчиков канала."""
+    user_tg_ids = list(user_tg_ids)
+    profiles = {}
+    for i in range(0, len(user_tg_ids), chunk_size):
+        chunk = user_tg_ids[i:i + chunk_size]
+        placeholders = ", ".join("?" * len(chunk))
+        async with db.execute(f"SELECT user_tg_id, username, first_name, last_name FROM subscribers "
+                              f"WHERE channel_tg_id = ? AND user_tg_id IN ({placeholders})",
+                              (channel_tg_id, *chunk)) as cursor:
+            async for row in cursor:
+                profiles[row[0]] = row[1:]
+    return profiles
+
+
+async def add_subscribers(channel_tg_id, users, commit=True):
+    """Добавляет подписчиков канала в базу данных одним запросом."""
+    async with db_transaction(commit):
+        await db.executemany("""
+        INSERT OR IGNORE INTO subscribers (channel_tg_id, user_tg_id, username, first_name, last_name, fingerprint)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """, [(channel_tg_id, user.id, user.username, user.first_name, user.last_name, user_fingerprint(user))
+              for user in users])
+
+
+async def update_subscriber_profiles(channel_tg_id, users, commit=True):
+    """Обновляет профили и отпечатки подписчиков канала одним запросом."""
+    async with db_transaction(commit):
+        await db.executemany("""
+        UPDATE subscribers SET username = ?, first_name = ?, last_name = ?, fingerprint = ?
+        WHERE channel_tg_id = ? AND user_tg_id = ?
+        """, [(user.username, user.first_name, user.last_name, user_fingerprint(user), channel_tg_id, user.id)
+              for user in users])
+
+
+async def remove_subscribers(channel_tg_id, user_tg_ids, commit=True):
+    """Удаляет подписчиков канала из базы данных одним запросом."""
+    async with db_transaction(commit):
+        await db.executemany("DELETE FROM subscribers WHERE channel_tg_id = ? AND user_tg_id = ?",
+                             [(channel_tg_id, user_tg_id) for user_tg_id in user_tg_ids])
+
+
+async def log_actions(actions, channel_tg_id, commit=True):
+    """
+    Логирует действия подписчиков в таблицу actions одним запросом
+    и прибавляет их к почасовым и посуточным счётчикам.
+    actions — список кортежей (user_tg_id, username, first_name, last_name, action).
+    """
     time_utc = datetime.now(timezone.utc).isoformat()
-    await db.execute("""
-    INSERT INTO actions (user_tg_id, user_tg_username, user_tg_name, user_tg_surname, action, time_utc, channel_tg_id)
-    VALUES (?, ?, ?, ?, ?, ?, ?)
-    """, (user_tg_id, username, first_name, last_name, action, time_utc, channel_tg_id))
-    await db.commit()
+    subscribed = sum(1 for action in actions if action[4] == "SUBSCRIBED")
+    unsubscribed = sum(1 for action in actions if action[4] == "UNSUBSCRIBED")
+    async with db_transaction(commit):
+        await db.executemany("""
+        INSERT INTO actions (user_tg_id, user_tg_username, user_tg_name, user_tg_surname, action, time_utc, channel_tg_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, [(*action, time_utc, channel_tg_id) for action in actions])
+        if subscribed or unsubscribed:
+            for table, length in ROLLUP_TABLES.items():
+                await db.execute(f"""
+                INSERT INTO {table} (channel_tg_id, bucket, subscribed, unsubscribed) VALUES (?, ?, ?, ?)
+                ON CONFLICT(channel_tg_id, bucket) DO UPDATE SET
+                    subscribed = subscribed + excluded.subscribed,
+                    unsubscribed = unsubscribed + excluded.unsubscribed
+                """, (channel_tg_id, time_utc[:length], subscribed, unsubscribed))
+
+
+async def save_subscriber_diff(channel_tg_id, new_users, removed_ids, actions, admin_log_cursor=None,
+                               changed_users=(), cycle_checkpoint=None):
+    """
+    Сохраняет результат цикла опроса одной транзакцией: новых подписчиков,
+    отписавшихся, изменившиеся профили, записи в actions и (если переданы)
+    курсор журнала действий и контрольную точку цикла.
+    """
+    async with db_transaction():
+        await add_subscribers(channel_tg_id, new_users, commit=False)
+        await remove_subscribers(channel_tg_id, removed_ids, commit=False)
+        if changed_users:
+            await update_subscriber_profiles(channel_tg_id, changed_users, commit=False)
+        await log_actions(actions, channel_tg_id, commit=False)
+        if admin_log_cursor is not None:
+            await set_admin_log_cursor(channel_tg_id, admin_log_cursor, commit=False)
+        if cycle_checkpoint is not None:
+            await set_cycle_checkpoint(channel_tg_id, *cycle_checkpoint, commit=False)
+
+
+async def save_roster_checkpoint(channel_tg_id, ids, time_utc=None, commit=True):
+    """
+    Сохраняет контрольную точку состава канала на момент time_utc (по умолчанию
+    сейчас): отсортированный массив id, сжатый zlib.
+    """
+    time_utc = time_utc or datetime.now(timezone.utc).isoformat()
+    async with db_transaction(commit):
+        await db.execute("""
+        INSERT INTO roster_checkpoints (channel_tg_id, time_utc, member_count, ids) VALUES (?, ?, ?, ?)
+        """, (channel_tg_id, time_utc, len(ids), zlib.compress(ids.tobytes())))
+
+
+async def get_roster_checkpoint(channel_tg_id, time_utc):
+    """
+    Последняя контрольная точка канала не позже time_utc:
+    (time_utc, array('q')) или None.
+    """
+    async with db.execute("""
+    SELECT time_utc, ids FROM roster_checkpoints
+    WHERE channel_tg_id = ? AND time_utc <= ? ORDER BY time_utc DESC LIMIT 1
+    """, (channel_tg_id, time_utc)) as cursor:
+        row = await cursor.fetchone()
+    if row is None:
+        return None
+    ids = array('q')
+    ids.frombytes(zlib.decompress(row[1]))
+    return row[0], ids
+
+
+async def get_membership_changes(channel_tg_id, after, until):
+    """
+    Подписки и отписки канала с time_utc в (after, until]:
+    {user_tg_id: последнее действие пользователя}.
+    """
+    async with db.execute("""
+    SELECT user_tg_id, action FROM actions
+    WHERE channel_tg_id = ? AND time_utc > ? AND time_utc <= ?
+        AND action IN ('SUBSCRIBED', 'UNSUBSCRIBED')
+    ORDER BY id
+    """, (channel_tg_id, after, until)) as cursor:
+        return {user_tg_id: action async for user_tg_id, action in cursor}
+
+
+async def get_action_stats(period, unit):
+    """
+    Сумма подписок и отписок по каналам за последние period часов (unit="h")
+    или суток (unit="d") из таблиц счётчиков: {channel_tg_id: (subscribed, unsubscribed)}.
+    """
+    now = datetime.now(timezone.utc)
+    if unit == "h":
+        table = "actions_hourly"
+        since = (now - timedelta(hours=period - 1)).isoformat()[:ROLLUP_TABLES[table]]
+    else:
+        table = "actions_daily"
+        since = (now - timedelta(days=period - 1)).isoformat()[:ROLLUP_TABLES[table]]
+    async with db.execute(f"""
+    SELECT channel_tg_id, SUM(subscribed), SUM(unsubscribed) FROM {table}
+    WHERE bucket >= ? GROUP BY channel_tg_id
+    """, (since,)) as cursor:
+        rows = await cursor.fetchall()
+    return {row[0]: (row[1], row[2]) for row in rows}
+
+
+async def get_admin_log_cursor(channel_tg_id):
+    """Возвращает id последнего обработанного события журнала действий."""
+    async with db.execute("SELECT admin_log_max_id FROM tracking_state WHERE channel_tg_id = ?", (channel_tg_id,)) as cursor:
+        row = await cursor.fetchone()
+    return row[0] if row else 0
+
+
+async def set_admin_log_cursor(channel_tg_id, max_id, commit=True):
+    """Сохраняет id последнего обработанного события журнала действий."""
+    async with db_transaction(commit):
+        await db.execute("""
+        INSERT INTO tracking_state (channel_tg_id, admin_log_max_id) VALUES (?, ?)
+        ON CONFLICT(channel_tg_id) DO UPDATE SET admin_log_max_id = excluded.admin_log_max_id
+        """, (channel_tg_id, max_id))
+
+
+async def get_cycle_checkpoint(channel_tg_id):
+    """
+    Возвращает контрольную точку цикла опроса: (время последней полной сверки
+    в ISO UTC, отпечаток списка участников (count, hash)) или None.
+    """
+    async with db.execute("""
+    SELECT reconcile_time_utc, precheck_count, precheck_hash FROM tracking_state WHERE channel_tg_id = ?
+    """, (channel_tg_id,)) as cursor:
+        row = await cursor.fetchone()
+    if not row or row[0] is None:
+        return None
+    return row[0], (row[1], row[2])
+
+
+async def set_cycle_checkpoint(channel_tg_id, reconcile_time_utc, fingerprint, commit=True):
+    """Сохраняет время последней полной сверки и отпечаток списка участников."""
+    count, recent_hash = fingerprint or (None, None)
+    async with db_transaction(commit):
+        await db.execute("""
+        INSERT INTO tracking_state (channel_tg_id, reconcile_time_utc, precheck_count, precheck_hash)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(channel_tg_id) DO UPDATE SET
+            reconcile_time_utc = excluded.reconcile_time_utc,
+            precheck_count = excluded.precheck_count,
+            precheck_hash = excluded.precheck_hash
+        """, (channel_tg_id, reconcile_time_utc, count, recent_hash))
 
 # ------------------------------------------------------------------------------
-# ИНИЦИАЛИЗАЦИЯ
+# ИНДЕКС ПОДПИСЧИКОВ
 # ------------------------------------------------------------------------------
 
 
-async def init_clients():
+def sorted_id_array(ids):
+    """Строит отсортированный массив int64 из уникальных id."""
+    if load_numpy() is not None:
+        unique = np.unique(np.fromiter(ids, dtype=np.int64))
+        result = array('q')
+        result.frombytes(unique.tobytes())
+        return result
+    return array('q', sorted(set(ids)))
+
+
+def sorted_id_fingerprints(ids, fingerprints):
+    """
+    Сортирует id вместе с выровненными отпечатками профилей, убирая повторы id.
+    Возвращает (array('q'), array('I')).
+    """
+    if load_numpy() is not None:
+        ids = ids if isinstance(ids, array) else array('q', ids)
+        fingerprints = fingerprints if isinstance(fingerprints, array) else array('I', fingerprints)
+        unique, positions = np.unique(np.frombuffer(ids, dtype=np.int64), return_index=True)
+        result_ids, result_fingerprints = array('q'), array('I')
+        result_ids.frombytes(unique.tobytes())
+        result_fingerprints.frombytes(
+            np.frombuffer(fingerprints, dtype=np.uint32)[positions].tobytes())
+        return result_ids, result_fingerprints
+    pairs = sorted(dict(zip(ids, fingerprints)).items())
+    return array('q', (uid for uid, _ in pairs)), array('I', (fingerprint for _, fingerprint in pairs))
+
+
+def profile_fingerprint(username, first_name, last_name):
+    """Отпечаток профиля подписчика: crc32 от username, имени и фамилии."""
+    return zlib.crc32("\x00".join((username or "", first_name or "", last_name or "")).encode())
+
+
+def user_fingerprint(user):
+    """Отпечаток профиля объекта User."""
+    return profile_fingerprint(user.username, user.first_name, user.last_name)
+
+
+def sorted_difference(a, b):
+    """Разность отсортированных массивов id a и b (элементы a, которых нет в b)."""
+    if not a or not b:
+        return array('q', a)
+    if load_numpy() is not None:
+        diff = np.setdiff1d(np.frombuffer(a, dtype=np.int64),
+                            np.frombuffer(b, dtype=np.int64), assume_unique=True)
+        result = array('q')
+        result.frombytes(diff.tobytes())
+        return result
+    # Слияние двух отсортированных последовательностей за O(len(a) + len(b))
+    result = array('q')
+    j, len_b = 0, len(b)
+    for x in a:
+        while j < len_b and b[j] < x:
+            j += 1
+        if j < len_b and b[j] == x:
+            continue
+        result.append(x)
+    return result
+
+
+class CompactSubscriberIndex:
+    """
+    Компактный индекс подписчиков канала для ROSTER_MODE=compact:
+    хранит отсортированный массив id и выровненный с ним массив отпечатков
+    профилей (12 байт на подписчика), профили отписавшихся при необходимости
+    читаются из базы.
+    """
+    __slots__ = ('ids', 'fingerprints')
+
+    def __init__(self, ids=(), fingerprints=None):
+        # ids — уже отсортированный array('q') без повторов или любая последовательность id
+        self.ids = ids if isinstance(ids, array) else sorted_id_array(ids)
+        # Отпечаток 0 — профиль неизвестен
+        self.fingerprints = fingerprints if fingerprints is not None else array('I', bytes(4 * len(self.ids)))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, uid):
+        i = bisect.bisect_left(self.ids, uid)
+        return i < len(self.ids) and self.ids[i] == uid
+
+    def missing(self, ids):
+        """Возвращает те из ids, которых нет в индексе."""
+        if load_numpy() is not None and self.ids:
+            ids = np.fromiter(ids, dtype=np.int64)
+            index_ids = np.frombuffer(self.ids, dtype=np.int64)
+            positions = np.searchsorted(index_ids, ids)
+            found = index_ids[np.minimum(positions, len(index_ids) - 1)] == ids
+            return ids[~found].tolist()
+        return [uid for uid in ids if uid not in self]
+
+    def changed(self, fingerprints):
+        """
+        Принимает {id: отпечаток профиля} и возвращает id, которые есть в индексе,
+        но с другим отпечатком.
+        """
+        if load_numpy() is not None and self.ids and fingerprints:
+            ids = np.fromiter(fingerprints.keys(), dtype=np.int64, count=len(fingerprints))
+            values = np.fromiter(fingerprints.values(), dtype=np.uint32, count=len(fingerprints))
+            index_ids = np.frombuffer(self.ids, dtype=np.int64)
+            positions = np.minimum(np.searchsorted(index_ids, ids), len(index_ids) - 1)
+            stored = np.frombuffer(self.fingerprints, dtype=np.uint32)[positions]
+            return ids[(index_ids[positions] == ids) & (stored != values)].tolist()
+        result = []
+        for uid, fingerprint in fingerprints.items():
+            i = bisect.bisect_left(self.ids, uid)
+            if i < len(self.ids) and self.ids[i] == uid and self.fingerprints[i] != fingerprint:
+                result.append(uid)
+        return result
+
+    def update(self, added, removed_ids, changed=None):
+        """
+        Добавляет ({id: отпечаток}) и удаляет id, сохраняя массивы отсортированными,
+        и обновляет отпечатки изменившихся профилей ({id: отпечаток}).
+        """
+        ids, fingerprints = self.ids, self.fingerprints
+        if removed_ids:
+            if load_numpy() is not None:
+                keep = ~np.isin(np.frombuffer(ids, dtype=np.int64),
+                                np.fromiter(removed_ids, dtype=np.int64))
+                kept_ids, kept_fingerprints = array('q'), array('I')
+                kept_ids.frombytes(np.frombuffer(ids, dtype=np.int64)[keep].tobytes())
+                kept_fingerprints.frombytes(np.frombuffer(fingerprints, dtype=np.uint32)[keep].tobytes())
+                ids, fingerprints = kept_ids, kept_fingerprints
+            else:
+                removed = set(removed_ids)
+                kept = [i for i, uid in enumerate(ids) if uid not in removed]
+                ids = array('q', (ids[i] for i in kept))
+                fingerprints = array('I', (fingerprints[i] for i in kept))
+        if added:
+            ids, fingerprints = sorted_id_fingerprints(ids + array('q', added.keys()),
+                                                       fingerprints + array('I', added.values()))
+        self.ids, self.fingerprints = ids, fingerprints
+        for uid, fingerprint in (changed or {}).items():
+            i = bisect.bisect_left(self.ids, uid)
+            if i < len(self.ids) and self.ids[i] == uid:
+                self.fingerprints[i] = fingerprint
+
+
+async def load_subscriber_index(channel_id):
+    """Загружает из базы индекс подписчиков канала в соответствии с ROSTER_MODE."""
+    if ROSTER_MODE == "compact":
+        return CompactSubscriberIndex(*await get_stored_subscriber_fingerprints(channel_id))
+    return await get_stored_subscribers(channel_id)
+
+
+class SubscriberIndexBuilder:
+    """Собирает индекс подписчиков постранично, по мере загрузки участников."""
+
+    def __init__(self):
+        self.ids = array('q')
+        self.fingerprints = array('I')
+        self.profiles = {}
+
+    def add_page(self, users):
+        """Добавляет страницу участников."""
+        if ROSTER_MODE == "compact":
+            self.ids.extend(user.id for user in users)
+            self.fingerprints.extend(user_fingerprint(user) for user in users)
+        else:
+            self.profiles.update({user.id: (user.username, user.first_name, user.last_name)
+                                  for user in users})
+
+    def unique_count(self):
+        """Число разных участников: поисковые шарды пересекаются, и id повторяются."""
+        if ROSTER_MODE == "compact":
+            return len(set(self.ids))
+        return len(self.profiles)
+
+    def build(self):
+        """Возвращает готовый индекс."""
+        if ROSTER_MODE == "compact":
+            return CompactSubscriberIndex(*sorted_id_fingerprints(self.ids, self.fingerprints))
+        return self.profiles
+
+
+class RosterDiff:
+    """
+    Потоковое сравнение списка участников с индексом: страницы подаются
+    в feed() по мере загрузки, в памяти остаются только id и новые подписчики.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.compact = isinstance(index, CompactSubscriberIndex)
+        self.seen_ids = array('q') if self.compact else set()
+        self.new_subscribers = {}  # {user_id: User}
+        self.changed_profiles = {}  # {user_id: User}
+
+    def feed(self, page):
+        """Обрабатывает очередную страницу участников."""
+        users = {user.id: user for user in page}
+        if self.compact:
+            self.seen_ids.extend(users)
+            joined_ids = self.index.missing(users)
+        else:
+            self.seen_ids.update(users)
+            joined_ids = [uid for uid in users if uid not in self.index]
+        for uid in joined_ids:
+            self.new_subscribers[uid] = users[uid]
+
+        if PROFILE_TRACKING == "off":
+            return
+        if self.compact:
+            # Компактный индекс хранит только отпечатки профилей
+            changed_ids = self.index.changed(
+                {uid: user_fingerprint(user) for uid, user in users.items()})
+        else:
+            # В словаре поля профиля уже в памяти: сравнить кортежи дешевле хеширования
+            changed_ids = [uid for uid, user in users.items()
+                           if uid in self.index
+                           and self.index[uid] != (user.username, user.first_name, user.last_name)]
+        for uid in changed_ids:
+            self.changed_profiles[uid] = users[uid]
+
+    def finish(self):
+        """Возвращает (id отписавшихся, всего подписчиков) после последней страницы."""
+        if self.compact:
+            current_ids = sorted_id_array(self.seen_ids)
+            return sorted_difference(self.index.ids, current_ids).tolist(), len(current_ids)
+        return [uid for uid in self.index if uid not in self.seen_ids], len(self.seen_ids)
+
+
+def subscriber_index_ids(index):
+    """Отсортированный массив id подписчиков из индекса любого вида."""
+    if isinstance(index, CompactSubscriberIndex):
+        return index.ids
+    return sorted_id_array(index)
+
+
+async def get_index_profiles(channel_id, index, user_ids):
+    """Возвращает {user_id: (username, first_name, last_name)} для подписчиков из индекса."""
+    if isinstance(index, CompactSubscriberIndex):
+        return await get_subscriber_profiles(channel_id, user_ids)
+    return {uid: index[uid] for uid in user_ids}
+
+
+def update_subscriber_index(index, new_subscribers, left_ids, changed_profiles=None):
+    """Применяет к индексу изменения, уже записанные в базу."""
+    changed_profiles = changed_profiles or {}
+    if isinstance(index, CompactSubscriberIndex):
+        index.update({uid: user_fingerprint(user) for uid, user in new_subscribers.items()}, left_ids,
+                     {uid: user_fingerprint(user) for uid, user in changed_profiles.items()})
+        return
+    for uid, user in (*new_subscribers.items(), *changed_profiles.items()):
+        index[uid] = (user.username, user.first_name, user.last_name)
+    for uid in left_ids:
+        index.pop(uid, None)
+
+# ------------------------------------------------------------------------------
+# ИСТОРИЯ СОСТАВА КАНАЛА
+# ------------------------------------------------------------------------------
+
+
+async def maybe_save_roster_checkpoint(channel_id):
+    """Сохраняет контрольную точку состава раз в CHECKPOINT_EVERY_CYCLES циклов опроса."""
+    if not CHECKPOINT_EVERY_CYCLES or channel_id not in subscriber_index:
+        return
+    checkpoint_cycles[channel_id] = checkpoint_cycles.get(channel_id, 0) + 1
+    if checkpoint_cycles[channel_id] >= CHECKPOINT_EVERY_CYCLES:
+        await save_roster_checkpoint(channel_id, subscriber_index_ids(subscriber_index[channel_id]))
+        checkpoint_cycles[channel_id] = 0
+
+
+async def rebuild_members(channel_tg_id, time_utc):
+    """
+    Состав канала на момент time_utc (строка ISO в UTC) в виде отсортированного
+    array('q'): последняя контрольная точка до этого момента плюс последующие
+    подписки и отписки. Стоимость — O(изменений от контрольной точки).
+    Возвращает None, если контрольной точки до этого момента нет.
+    """
+    checkpoint = await get_roster_checkpoint(channel_tg_id, time_utc)
+    if checkpoint is None:
+        return None
+    checkpoint_time, ids = checkpoint
+    changes = await get_membership_changes(channel_tg_id, checkpoint_time, time_utc)
+    removed = sorted_id_array(uid for uid, action in changes.items() if action == "UNSUBSCRIBED")
+    added = [uid for uid, action in changes.items() if action == "SUBSCRIBED"]
+    members = sorted_difference(ids, removed)
+    if added:
+        members = sorted_id_array(list(members) + added)
+    return members
+
+
+async def get_members_at(channel_tg_id, moment):
+    """
+    Состав канала на момент moment (datetime или строка ISO; без часового
+    пояса считается UTC), см. rebuild_members. Возвращает None, если канал
+    тогда ещё не отслеживался или история за этот момент удалена.
+    """
+    if isinstance(moment, str):
+        moment = datetime.fromisoformat(moment)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    # Действия старше срока хранения удалены, а контрольные точки до них свёрнуты
+    if ACTIONS_RETENTION_DAYS and moment < datetime.now(timezone.utc) - timedelta(days=ACTIONS_RETENTION_DAYS):
+        return None
+    return await rebuild_members(channel_tg_id, moment.astimezone(timezone.utc).isoformat())
+
+# ------------------------------------------------------------------------------
+# ПУЛ АККАУНТОВ
+# ------------------------------------------------------------------------------
+
+
+class ClientPool:
     """
-    Инициализирует бота и клиентский аккаунт (пользовательский).
+    Пул пользовательских аккаунтов. Запросы get_entity, get_participants
+    и iter_participants распределяются по кругу между авторизованными
+    аккаунтами; аккаунт, получивший FloodWait, уходит на паузу, а запрос
+    повторяется на другом. Если на паузе все аккаунты, FloodWaitError
+    пробрасывается вызывающему коду с наименьшим временем ожидания.
     """
-    global user_client, bot, current_channel_id
 
-    # Инициализация базы данных
-    await init_db()
+    def __init__(self, clients=()):
+        self.clients = list(clients)
+        self.cooldown_until = {}  # клиент -> time.monotonic() конца паузы
+        self.unresolved = set()  # (клиент, сущность), которую аккаунт не видит
+        self.dialogs_loaded = set()  # клиенты, для которых загружены диалоги
+        self.next_index = 0
+
+    def add(self, client):
+        """Добавляет аккаунт в пул."""
+        self.clients.append(client)
+
+    def remove(self, client):
+        """Убирает аккаунт из пула."""
+        self.clients.remove(client)
+        self.cooldown_until.pop(client, None)
+        self.dialogs_loaded.discard(client)
+
+    async def authorized(self):
+        """Подключённые и авторизованные аккаунты пула."""
+        return [client for client in self.clients
+                if client.is_connected() and await client.is_user_authorized()]
+
+    async def primary(self):
+        """
+        Аккаунт для запросов, которые идут не по кругу (журнал действий,
+        предварительная проверка, метаданные канала): основной, если он
+        авторизован, иначе первый авторизованный аккаунт пула.
+        """
+        authorized = await self.authorized()
+        if not authorized:
+            raise RuntimeError("Нет авторизованного пользовательского аккаунта")
+        return authorized[0]
+
+    def cool_down(self, client, seconds):
+        """Ставит аккаунт на паузу после FloodWait."""
+        self.cooldown_until[client] = time.monotonic() + seconds
+        FLOOD_WAIT_SECONDS.inc(seconds, source="account")
+        logging.warning(f"FloodWait у аккаунта №{self.clients.index(client) + 1}, пауза {seconds} с")
+
+    async def can_resolve(self, client, entity):
+        """
+        Может ли аккаунт обратиться к сущности: числовой id канала известен
+        аккаунту, только если канал есть в его кэше, поэтому при первой
+        неудаче загружаются диалоги аккаунта.
+        """
+        if not isinstance(entity, int) or (client, entity) in self.unresolved:
+            return (client, entity) not in self.unresolved
+        try:
+            await client.get_input_entity(entity)
+            return True
+        except ValueError:
+            if client not in self.dialogs_loaded:
+                self.dialogs_loaded.add(client)
+                await client.get_dialogs()
+                return await self.can_resolve(client, entity)
+            self.unresolved.add((client, entity))
+            return False
+
+    async def acquire(self, entity=None):
+        """Следующий по кругу аккаунт, который не на паузе и видит сущность."""
+        candidates = [client for client in await self.authorized()
+                      if await self.can_resolve(client, entity)]
+        if not candidates:
+            raise RuntimeError("Нет авторизованного аккаунта с доступом к каналу")
+        now = time.monotonic()
+        ready = [client for client in candidates if self.cooldown_until.get(client, 0) <= now]
+        if not ready:
+            wait = min(self.cooldown_until[client] for client in candidates) - now
+            raise errors.FloodWaitError(request=None, capture=max(1, round(wait)))
+        self.next_index += 1
+        return ready[self.next_index % len(ready)]
+
+    async def call(self, method, entity, *args, **kwargs):
+        """Вызывает метод клиента (get_entity, get_participants) на свободном аккаунте."""
+        while True:
+            client = await self.acquire(entity)
+            try:
+                return await getattr(client, method)(entity, *args, **kwargs)
+            except errors.FloodWaitError as e:
+                self.cool_down(client, e.seconds)
+
+    async def iter_participants(self, entity, **kwargs):
+        """
+        iter_participants на свободном аккаунте. При FloodWait выдача
+        начинается заново на другом аккаунте, поэтому участники могут повторяться.
+        """
+        while True:
+            client = await self.acquire(entity)
+            try:
+                async for user in client.iter_participants(entity, **kwargs):
+                    yield user
+                return
+            except errors.FloodWaitError as e:
+                self.cool_down(client, e.seconds)
+
+
+def new_session_name():
+    """Имя сессии для нового аккаунта: <основная сессия>_<номер>."""
+    base = USER_SESSION_NAMES[0].removesuffix(".session")
+    taken = {getattr(client.session, 'filename', None) for client in user_pool.clients}
+    number = len(user_pool.clients) + 1
+    while f"{base}_{number}.session" in taken or os.path.exists(f"{base}_{number}.session"):
+        number += 1
+    return f"{base}_{number}.session"
+
+# ------------------------------------------------------------------------------
+# ИНИЦИАЛИЗАЦИЯ
+# ------------------------------------------------------------------------------
+
 
-    # Бот
-    bot = TelegramClient(
+def recorded(client, label):
+    """Оборачивает клиент для записи обращений к Telegram, если она включена."""
+    if traffic_recorder is None:
+        return client
+    return traffic_recorder.wrap(client, label)
+
+
+async def start_bot():
+    """Создаёт и запускает бота."""
+    global bot
+    bot = recorded(TelegramClient(
         SESSION_NAME_BOT,
         API_ID,
         API_HASH
-    )
+    ), "bot")
     await bot.start(bot_token=BOT_TOKEN)
     logging.info("Бот успешно запущен.")
 
-    # Пользовательский клиент
-    user_client = TelegramClient(
-        SESSION_NAME_USER,
-        API_ID,
-        API_HASH
-    )
-    # user_client не запускаем сразу через start(phone=...),
-    # потому что авторизация будет через /login
-    await user_client.connect()
-    logging.info("Пользовательский клиент подключён.")
-
-    # Получаем текущий канал из базы данных
-    tracked_channel = await get_tracked_channel()
-    if tracked_channel:
-        current_channel_id = tracked_channel['tg_id']
+
+async def connect_user_clients(session_names):
+    """
+    Подключает пользовательские аккаунты параллельно и добавляет их в пул
+    в порядке session_names. Их не запускаем сразу через start(phone=...),
+    потому что авторизация будет через /login.
+    """
+    clients = [recorded(TelegramClient(session_name, API_ID, API_HASH), session_name)
+               for session_name in session_names]
+    await asyncio.gather(*(client.connect() for client in clients))
+    for client in clients:
+        user_pool.add(client)
+
+
+async def init_clients():
+    """
+    Инициализирует базу данных, бота и пользовательские аккаунты.
+    Открытие базы и подключение клиентов выполняются параллельно.
+    """
+    global user_client, user_pool, poll_semaphore, notification_queue, notify_bucket, traffic_recorder
+
+    if TG_RECORD_PATH:
+        from replay import TrafficRecorder
+        traffic_recorder = TrafficRecorder(TG_RECORD_PATH)
+        logging.info(f"Обращения к Telegram записываются в {TG_RECORD_PATH}")
+    poll_semaphore = asyncio.Semaphore(MAX_CONCURRENT_POLLS)
+    notification_queue = asyncio.Queue()
+    notify_bucket = TokenBucket(NOTIFY_RATE_PER_SECOND, NOTIFY_BURST)
+
+    # Пользовательские аккаунты: из TG_USER_SESSION_NAMES и добавленные через /login new
+    user_pool = ClientPool()
+    await asyncio.gather(init_db(), start_bot(), connect_user_clients(USER_SESSION_NAMES))
+    # Аккаунты из базы известны только после её открытия
+    await connect_user_clients(
+        [name for name in dict.fromkeys(await get_user_sessions()) if name not in USER_SESSION_NAMES])
+    user_client = user_pool.clients[0]
+    logging.info(f"Пользовательских аккаунтов подключено: {len(user_pool.clients)}")
+
+    await load_tracked_channels()
+
+
+async def load_tracked_channels():
+    """
+    Загружает отслеживаемые каналы из базы: индексы подписчиков и контрольные
+    точки цикла; прерванные начальные импорты запускаются заново.
+    """
+    for channel in await get_tracked_channels():
+        if not channel['baseline_ready']:
+            # Импорт прервался при прошлом запуске — начинаем его заново
+            await set_tracked_channel(channel['tg_id'], channel['name'],
+                                      channel['username'], channel['poll_interval'])
+            cache_channel_metadata(channel['tg_id'], title=channel['name'], username=channel['username'])
+            start_channel_import(channel['tg_id'])
+            continue
+        tracked_channels[channel['tg_id']] = channel
+        subscriber_index[channel['tg_id']] = await load_subscriber_index(channel['tg_id'])
+        await restore_cycle_checkpoint(channel['tg_id'])
         logging.info(
-            f"Отслеживаемый канал: {tracked_channel['name']} (@{tracked_channel['username']}) id:{tracked_channel['tg_id']}")
-    else:
+            f"Отслеживаемый канал: {channel['name']} (@{channel['username']}) id:{channel['tg_id']}")
+    if not tracked_channels and not import_tasks:
         logging.info(
-            "Нет отслеживаемого канала. Используйте /setchannel для установки.")
+            "Нет отслеживаемых каналов. Используйте /setchannel для добавления.")
+
+
+async def restore_cycle_checkpoint(channel_id):
+    """
+    Восстанавливает после перезапуска время последней полной сверки и отпечаток
+    списка участников, чтобы канал сразу продолжил инкрементальное
+    отслеживание вместо полной загрузки.
+    """
+    checkpoint = await get_cycle_checkpoint(channel_id)
+    if checkpoint is None:
+        return
+    reconcile_time_utc, fingerprint = checkpoint
+    age = (datetime.now(timezone.utc) - datetime.fromisoformat(reconcile_time_utc)).total_seconds()
+    last_reconcile_at[channel_id] = time.monotonic() - max(age, 0)
+    if fingerprint[0] is not None:
+        roster_fingerprints[channel_id] = fingerprint
 
 # ------------------------------------------------------------------------------
-# ПОЛЛИНГ
+# ИНКРЕМЕНТАЛЬНОЕ ОТСЛЕЖИВАНИЕ
 # ------------------------------------------------------------------------------
 
+# Фильтр журнала действий: только вступления, выходы, приглашения и исключения
+ADMIN_LOG_FILTER = types.ChannelAdminLogEventsFilter(
+    join=True, leave=True, invite=True, kick=True)
+ADMIN_LOG_PAGE_LIMIT = 100
 
-async def polling_task():
+
+def participant_is_member(participant):
+    """Проверяет, означает ли объект ChannelParticipant членство в канале."""
+    if participant is None or isinstance(participant, types.ChannelParticipantLeft):
+        return False
+    if isinstance(participant, types.ChannelParticipantBanned):
+        return not (participant.left or participant.banned_rights.view_messages)
+    return True
+
+
+async def on_channel_participant_update(update):
+    """
+    Обработчик обновлений UpdateChannelParticipant пользовательского клиента.
+    Складывает вступления/выходы в очередь канала, которую разбирает его цикл опроса.
+    """
+    channel_id = utils.get_peer_id(types.PeerChannel(update.channel_id))
+    if channel_id not in tracked_channels:
+        return
+    pending_participant_updates.setdefault(channel_id, []).append(
+        (update.user_id, participant_is_member(update.new_participant)))
+
+
+def admin_log_event_change(event):
     """
-    Фоновая задача, которая периодически проверяет подписчиков канала.
+    Преобразует событие журнала действий в пару (user_id, вступил ли).
+    Возвращает None для событий, не связанных с подпиской.
     """
+    action = event.action
+    if isinstance(action, (types.ChannelAdminLogEventActionParticipantJoin,
+                           types.ChannelAdminLogEventActionParticipantJoinByInvite,
+                           types.ChannelAdminLogEventActionParticipantJoinByRequest)):
+        return event.user_id, True
+    if isinstance(action, types.ChannelAdminLogEventActionParticipantLeave):
+        return event.user_id, False
+    if isinstance(action, types.ChannelAdminLogEventActionParticipantInvite):
+        return action.participant.user_id, True
+    if isinstance(action, types.ChannelAdminLogEventActionParticipantToggleBan):
+        peer = action.new_participant.peer if isinstance(
+            action.new_participant, types.ChannelParticipantBanned) else None
+        if peer is not None and not participant_is_member(action.new_participant):
+            return utils.get_peer_id(peer), False
+    return None
+
+
+async def fetch_admin_log_events(channel_id, min_id):
+    """
+    Получает события журнала действий с id > min_id (постранично).
+    Возвращает (список событий по возрастанию id, {user_id: User}).
+    """
+    client = await user_pool.primary()
+    channel = await client.get_input_entity(channel_id)
+    events_ = []
+    users = {}
+    max_id = 0
     while True:
-        try:
-            if current_channel_id is None:
-                await asyncio.sleep(POLLING_INTERVAL_SECONDS)
-                continue
+        result = await client(functions.channels.GetAdminLogRequest(
+            channel=channel,
+            q='',
+            max_id=max_id,
+            min_id=min_id,
+            limit=ADMIN_LOG_PAGE_LIMIT,
+            events_filter=ADMIN_LOG_FILTER
+        ))
+        events_.extend(result.events)
+        users.update({user.id: user for user in result.users})
+        if len(result.events) < ADMIN_LOG_PAGE_LIMIT:
+            break
+        max_id = min(event.id for event in result.events)
+    events_.sort(key=lambda event: event.id)
+    return events_, users
+
+
+async def get_latest_admin_log_id(channel_id):
+    """Возвращает id самого свежего события журнала действий (0, если событий нет)."""
+    client = await user_pool.primary()
+    channel = await client.get_input_entity(channel_id)
+    result = await client(functions.channels.GetAdminLogRequest(
+        channel=channel, q='', max_id=0, min_id=0, limit=1, events_filter=ADMIN_LOG_FILTER))
+    return result.events[0].id if result.events else 0
+
+
+def reconcile_due(channel_id):
+    """Нужна ли полная сверка списка подписчиков канала в текущем цикле."""
+    if TRACKING_MODE != "incremental" or channel_id not in last_reconcile_at:
+        return True
+    return time.monotonic() - last_reconcile_at[channel_id] >= RECONCILE_INTERVAL_SECONDS
 
-            if not user_client.is_connected() or not (await user_client.is_user_authorized()):
-                logging.warning(
-                    "Пользовательский клиент не авторизован. Пропуск polling.")
-                await asyncio.sleep(POLLING_INTERVAL_SECONDS)
+# ------------------------------------------------------------------------------
+# УВЕДОМЛЕНИЯ
+# ------------------------------------------------------------------------------
+
+# Максимальная длина одного сообщения Telegram (с запасом)
+MAX_MESSAGE_LENGTH = 4000
+
+
+class TokenBucket:
+    """Ограничитель частоты отправки: rate токенов в секунду, не больше capacity подряд."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+
+    def pause(self, seconds):
+        """Приостанавливает выдачу токенов (например, на время FloodWait)."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self):
+        """Ждёт, пока не появится свободный токен, и забирает его."""
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
                 continue
+            self.tokens = min(self.capacity, self.tokens +
+                              (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
 
-            # Получаем текущий список подписчиков
-            participants = await user_client.get_participants(current_channel_id)
-            current_subscribers = {user.id: user for user in participants}
-            total_subscribers = len(current_subscribers)  # Get total count
-
-            # Получаем предыдущий список подписчиков из базы данных
-            stored_subscribers = await get_stored_subscribers()
-
-            # Вычисляем новых подписчиков и ушедших
-            new_subscribers = {uid: user for uid, user in current_subscribers.items(
-            ) if uid not in stored_subscribers}
-            unsubscribed = {uid: info for uid, info in stored_subscribers.items(
-            ) if uid not in current_subscribers}
-
-            # Отправляем уведомления о новых подписках
-            for uid, user in new_subscribers.items():
-                username = user.username or 'no_username'
-                first_name = user.first_name or ''
-                last_name = user.last_name or 'no_surname'
-                channel_info = await get_tracked_channel()
-                channel_username = channel_info['username'] if channel_info and channel_info['username'] else 'no_username'
-                channel_name = channel_info['name'] if channel_info else 'unknown_channel'
-
-                msg = (f"Зафиксирована ПОДПИСКА на канал @{channel_username}, "
-                       f"пользователь: @{username} {first_name} {last_name} (id{uid})\n"
-                       f"Всего подписчиков: {total_subscribers}")
-
-                if ADMIN_CHAT_ID != 0:
-                    try:
-                        await bot.send_message(ADMIN_CHAT_ID, msg)
-                        logging.info(
-                            f"Отправлено уведомление о подписке пользователя id{uid}")
-                    except Exception as e:
-                        logging.error(
-                            f"Не удалось отправить уведомление о подписке: {e}")
-
-                # Добавляем нового подписчика в базу данных
-                await add_subscriber(user)
-
-                # Логируем действие
-                await log_action(uid, username, first_name, last_name, "SUBSCRIBED", current_channel_id)
-
-            # Отправляем уведомления об отписках
-            for uid, info in unsubscribed.items():
-                username = info['username'] or 'no_username'
-                first_name = info['first_name'] or ''
-                last_name = info['last_name'] or 'no_surname'
-                channel_info = await get_tracked_channel()
-                channel_username = channel_info['username'] if channel_info and channel_info['username'] else 'no_username'
-                channel_name = channel_info['name'] if channel_info else 'unknown_channel'
-
-                msg = (f"Зафиксирована ОТПИСКА от канала @{channel_username}, "
-                       f"пользователь: @{username} {first_name} {last_name} (id{uid})\n"
-                       f"Всего подписчиков: {total_subscribers}")
-
-                if ADMIN_CHAT_ID != 0:
-                    try:
-                        await bot.send_message(ADMIN_CHAT_ID, msg)
+
+def enqueue_notifications(channel_id, channel_username, actions, total_subscribers):
+    """
+    Ставит уведомления о подписках/отписках в очередь отправки.
+    actions — список кортежей (user_tg_id, username, first_name, last_name, action).
+    """
+    if ADMIN_CHAT_ID == 0 or notification_queue is None:
+        return
+    queued_at = time.monotonic()
+    for uid, username, first_name, last_name, action in actions:
+        notification_queue.put_nowait({
+            'channel_id': channel_id,
+            'channel_username': channel_username,
+            'uid': uid,
+            'username': username,
+            'first_name': first_name,
+            'last_name': last_name,
+            'action': action,
+            'total': total_subscribers,
+            'queued_at': queued_at,
+        })
+
+
+def format_notification(item):
+    """Текст уведомления об одной подписке или отписке."""
+    if item['action'] == "SUBSCRIBED":
+        header = f"Зафиксирована ПОДПИСКА на канал @{item['channel_username']}"
+    else:
+        header = f"Зафиксирована ОТПИСКА от канала @{item['channel_username']}"
+    return (f"{header}, "
+            f"пользователь: @{item['username']} {item['first_name']} {item['last_name']} (id{item['uid']})\n"
+            f"Всего подписчиков: {item['total']}")
+
+
+def format_digest(items):
+    """
+    Сводка по пачке событий одного канала: заголовок «+N / -M за последние T с»
+    и постраничный список пользователей. Возвращает список сообщений.
+    """
+    joined = sum(1 for item in items if item['action'] == "SUBSCRIBED")
+    left = len(items) - joined
+    period = max(1, round(time.monotonic() -
+                 min(item['queued_at'] for item in items)))
+    last = items[-1]
+    header = (f"Канал @{last['channel_username']}: +{joined} / -{left} за последние {period} с\n"
+              f"Всего подписчиков: {last['total']}")
+
+    pages = []
+    lines = [header]
+    length = len(header)
+    for shown, item in enumerate(items):
+        sign = "+" if item['action'] == "SUBSCRIBED" else "-"
+        line = f"{sign} @{item['username']} {item['first_name']} {item['last_name']} (id{item['uid']})"
+        if length + len(line) + 1 > MAX_MESSAGE_LENGTH:
+            pages.append("\n".join(lines))
+            if len(pages) >= NOTIFY_DIGEST_MAX_PAGES:
+                pages[-1] += f"\n… и ещё {len(items) - shown}"
+                return pages
+            lines = []
+            length = 0
+        lines.append(line)
+        length += len(line) + 1
+    pages.append("\n".join(lines))
+    return pages
+
+
+async def send_notification(text):
+    """
+    Отправляет сообщение в ADMIN_CHAT_ID с учётом ограничения частоты.
+    При FloodWait ждёт указанное время и повторяет попытку.
+    """
+    for attempt in range(NOTIFY_MAX_RETRIES):
+        await notify_bucket.acquire()
+        try:
+            await bot.send_message(ADMIN_CHAT_ID, text)
+            NOTIFICATIONS_SENT.inc()
+            return True
+        except errors.FloodWaitError as e:
+            FLOOD_WAIT_SECONDS.inc(e.seconds, source="notify")
+            logging.warning(
+                f"FloodWait при отправке уведомления, пауза {e.seconds} с")
+            notify_bucket.pause(e.seconds)
+        except Exception as e:
+            logging.error(f"Не удалось отправить уведомление: {e}")
+            await asyncio.sleep(min(2 ** attempt, 60))
+    logging.error(
+        f"Уведомление не отправлено после {NOTIFY_MAX_RETRIES} попыток")
+    return False
+
+
+def debounce_notifications(batch):
+    """
+    Пропускает события через окно NOTIFY_DEBOUNCE_SECONDS: новые удерживаются,
+    пара противоположных действий одного пользователя в канале взаимно
+    отменяется. Возвращает уведомления, окно которых истекло.
+    """
+    if NOTIFY_DEBOUNCE_SECONDS <= 0:
+        return batch
+    for item in batch:
+        key = (item['channel_id'], item['uid'])
+        held = held_notifications.get(key)
+        if held is not None and held['action'] != item['action']:
+            del held_notifications[key]
+            NOTIFICATIONS_SUPPRESSED.inc(2)
+            logging.info(
+                f"Подписка и отписка пользователя id{item['uid']} в канале {item['channel_id']} "
+                f"за {NOTIFY_DEBOUNCE_SECONDS} с — уведомления отменены")
+        else:
+            held_notifications[key] = item
+
+    now = time.monotonic()
+    ready = [key for key, item in held_notifications.items()
+             if now - item['queued_at'] >= NOTIFY_DEBOUNCE_SECONDS]
+    return [held_notifications.pop(key) for key in ready]
+
+
+async def next_notifications():
+    """
+    Ждёт событий в очереди и собирает их за окно NOTIFY_COALESCE_SECONDS.
+    Пока есть удерживаемые уведомления, ждёт не дольше истечения их окна
+    и может вернуть пустой список.
+    """
+    if held_notifications:
+        deadline = min(item['queued_at'] for item in held_notifications.values()) + NOTIFY_DEBOUNCE_SECONDS
+        try:
+            batch = [await asyncio.wait_for(notification_queue.get(), max(0, deadline - time.monotonic()))]
+        except asyncio.TimeoutError:
+            return []
+    else:
+        batch = [await notification_queue.get()]
+    await asyncio.sleep(NOTIFY_COALESCE_SECONDS)
+    while not notification_queue.empty():
+        batch.append(notification_queue.get_nowait())
+    return batch
+
+
+async def notification_task():
+    """
+    Фоновая задача отправки уведомлений. Собирает события из очереди за
+    окно NOTIFY_COALESCE_SECONDS и пропускает через окно подавления мерцаний;
+    если по каналу накопилось больше NOTIFY_DIGEST_THRESHOLD событий,
+    отправляет одну сводку вместо отдельных сообщений.
+    """
+    while True:
+        batch = debounce_notifications(await next_notifications())
+        if not batch:
+            continue
+
+        by_channel = {}
+        for item in batch:
+            by_channel.setdefault(item['channel_id'], []).append(item)
+
+        for channel_id, items in by_channel.items():
+            try:
+                if len(items) > NOTIFY_DIGEST_THRESHOLD:
+                    for page in format_digest(items):
+                        await send_notification(page)
+                    logging.info(
+                        f"Отправлена сводка по каналу {channel_id}: {len(items)} событий")
+                    continue
+                for item in items:
+                    if await send_notification(format_notification(item)):
+                        action_name = "о подписке" if item['action'] == "SUBSCRIBED" else "об отписке"
                         logging.info(
-                            f"Отправлено уведомление об отписке пользователя id{uid}")
-                    except Exception as e:
-                        logging.error(
-                            f"Не удалось отправить уведомление об отписке: {e}")
+                            f"Отправлено уведомление {action_name} пользователя id{item['uid']}")
+            except Exception as e:
+                logging.error(f"Ошибка в notification_task: {e}")
+
+# ------------------------------------------------------------------------------
+# МЕТАДАННЫЕ КАНАЛОВ
+# ------------------------------------------------------------------------------
+
+
+def cache_channel_metadata(channel_id, **fields):
+    """
+    Обновляет кэш метаданных канала. Значения None не затирают
+    уже известные (например, цикл опроса знает только число подписчиков).
+    """
+    entry = channel_metadata.setdefault(
+        channel_id, {'title': None, 'username': None, 'participants_count': None})
+    entry.update({key: value for key, value in fields.items() if value is not None})
+    entry['updated_at'] = time.monotonic()
+
+
+def cache_full_channel(channel_id, full):
+    """Кладёт в кэш результат GetFullChannelRequest."""
+    chat = next((chat for chat in full.chats if chat.id == full.full_chat.id), None)
+    cache_channel_metadata(channel_id,
+                           title=chat and chat.title,
+                           username=chat and chat.username,
+                           participants_count=full.full_chat.participants_count)
+
+
+def cached_channel_metadata(channel_id):
+    """Метаданные канала из кэша, если они не старше CHANNEL_METADATA_TTL, иначе None."""
+    entry = channel_metadata.get(channel_id)
+    if entry and entry['participants_count'] is not None and \
+            time.monotonic() - entry['updated_at'] < CHANNEL_METADATA_TTL:
+        return entry
+    return None
+
+
+async def get_channel_metadata(channel_id):
+    """Метаданные канала: из кэша или через GetFullChannelRequest."""
+    entry = cached_channel_metadata(channel_id)
+    if entry is None:
+        client = await user_pool.primary()
+        channel = await client.get_input_entity(channel_id)
+        cache_full_channel(channel_id, await client(
+            functions.channels.GetFullChannelRequest(channel=channel)))
+        entry = channel_metadata[channel_id]
+    return entry
+
+# ------------------------------------------------------------------------------
+# ПОЛЛИНГ
+# ------------------------------------------------------------------------------
+
+
+async def get_roster_fingerprint(channel_id):
+    """
+    Дешёвый отпечаток списка участников: participants_count из GetFullChannelRequest
+    и (в режиме count_hash) crc32 id первой страницы недавних участников.
+    """
+    # Оба запроса от одного аккаунта, чтобы отпечатки циклов были сравнимы
+    client = await user_pool.primary()
+    channel = await client.get_input_entity(channel_id)
+    full = await client(functions.channels.GetFullChannelRequest(channel=channel))
+    cache_full_channel(channel_id, full)
+    recent_hash = None
+    if PRECHECK_MODE == "count_hash":
+        result = await client(functions.channels.GetParticipantsRequest(
+            channel=channel,
+            filter=types.ChannelParticipantsRecent(),
+            offset=0,
+            limit=PRECHECK_RECENT_LIMIT,
+            hash=0
+        ))
+        recent_ids = array('q', (user.id for user in result.users))
+        recent_hash = zlib.crc32(recent_ids.tobytes())
+    return full.full_chat.participants_count, recent_hash
+
+
+def precheck_allowed(channel_id):
+    """Можно ли пропустить полную загрузку по предварительной проверке."""
+    if PRECHECK_MODE == "off" or channel_id not in last_reconcile_at:
+        return False
+    return time.monotonic() - last_reconcile_at[channel_id] < RECONCILE_INTERVAL_SECONDS
+
+
+async def use_sharded_fetch(channel_id):
+    """
+    Нужна ли шардированная загрузка списка участников канала. В режиме auto
+    размер канала берётся из отпечатка или индекса, а если он неизвестен
+    (например, при /setchannel) — запрашивается через get_participants(limit=0).
+    """
+    if ROSTER_FETCH_MODE == "sharded":
+        return True
+    if ROSTER_FETCH_MODE != "auto":
+        return False
+    fingerprint = roster_fingerprints.get(channel_id)
+    if fingerprint and fingerprint[0] is not None:
+        known_count = fingerprint[0]
+    else:
+        known_count = len(subscriber_index.get(channel_id, ()))
+    if not known_count:
+        known_count = (await user_pool.call("get_participants", channel_id, limit=0)).total or 0
+    return known_count > SHARDED_FETCH_THRESHOLD
+
+
+def roster_shards():
+    """
+    Начальные шарды списка участников (аргументы iter_participants):
+    недавние, администраторы, боты и поиск по каждому символу SHARD_ALPHABET.
+    """
+    shards = [{'filter': types.ChannelParticipantsRecent()},
+              {'filter': types.ChannelParticipantsAdmins()},
+              {'filter': types.ChannelParticipantsBots()}]
+    shards.extend({'search': char} for char in SHARD_ALPHABET)
+    return shards
+
+
+async def iter_participant_pages(channel_id, page_size=None, sharded=False):
+    """
+    Потоково получает участников канала страницами (списками User).
+    Загрузка идёт в отдельной задаче: следующая страница запрашивается,
+    пока вызывающий код обрабатывает текущую.
+
+    При sharded=True список собирается из шардов roster_shards(), которые
+    загружаются параллельно (не больше SHARD_CONCURRENCY одновременно).
+    Поисковый шард, упёршийся в SHARD_REFINE_THRESHOLD, дробится на
+    более длинные префиксы. Один пользователь может попасть в несколько
+    шардов — потребители страниц должны быть устойчивы к повторам.
+    """
+    page_size = page_size or PARTICIPANTS_PAGE_SIZE
+    queue = asyncio.Queue(maxsize=2 * max(1, SHARD_CONCURRENCY if sharded else 1))
+    semaphore = asyncio.Semaphore(SHARD_CONCURRENCY)
+
+    async def fetch_shard(shard):
+        async with semaphore:
+            page = []
+            count = 0
+            async for user in user_pool.iter_participants(channel_id, **shard):
+                page.append(user)
+                count += 1
+                if len(page) >= page_size:
+                    await queue.put(page)
+                    page = []
+            if page:
+                await queue.put(page)
+            return count
+
+    async def producer():
+        try:
+            shards = roster_shards() if sharded else [{}]
+            while shards:
+                tasks = [asyncio.create_task(fetch_shard(shard)) for shard in shards]
+                try:
+                    counts = await asyncio.gather(*tasks)
+                except BaseException:
+                    # gather не отменяет остальные шарды при ошибке одного из них
+                    for task in tasks:
+                        task.cancel()
+                    raise
+                # Шарды, которые упёрлись в ограничение выдачи, уточняем префиксом
+                shards = [{'search': shard['search'] + char}
+                          for shard, count in zip(shards, counts)
+                          if 'search' in shard and count >= SHARD_REFINE_THRESHOLD
+                          and len(shard['search']) < SHARD_MAX_PREFIX_LENGTH
+                          for char in SHARD_ALPHABET]
+            await queue.put(None)
+        except Exception as e:
+            await queue.put(e)
+
+    task = asyncio.create_task(producer())
+    try:
+        while True:
+            page = await queue.get()
+            if page is None:
+                return
+            if isinstance(page, Exception):
+                raise page
+            yield page
+    finally:
+        task.cancel()
+
+
+async def fetch_full_diff(channel_id, stored_subscribers, expected_count=None):
+    """
+    Полная сверка: потоково загружает участников канала и сравнивает с индексом.
+    Возвращает (новые подписчики, id отписавшихся, всего подписчиков,
+    подписчики с изменившимся профилем).
+
+    При шардированной загрузке число найденных участников сравнивается
+    с participants_count канала (expected_count, если уже известен из отпечатка).
+    Если шарды покрыли список не полностью, отписки не возвращаются: пропущенные
+    участники выглядели бы отписавшимися.
+    """
+    started = time.perf_counter()
+    diff_seconds = 0.0
+    diff = RosterDiff(stored_subscribers)
+    sharded = await use_sharded_fetch(channel_id)
+    async for page in iter_participant_pages(channel_id, sharded=sharded):
+        page_started = time.perf_counter()
+        diff.feed(page)
+        diff_seconds += time.perf_counter() - page_started
+    finish_started = time.perf_counter()
+    left_ids, total_subscribers = diff.finish()
+    diff_seconds += time.perf_counter() - finish_started
+
+    if sharded and expected_count is None:
+        expected_count = (await user_pool.call("get_participants", channel_id, limit=0)).total
+    allowed_missing = max(
+        (expected_count or 0) * ROSTER_COVERAGE_TOLERANCE, ROSTER_COVERAGE_MIN_MISSING)
+    if sharded and expected_count and expected_count - total_subscribers > allowed_missing:
+        ROSTER_INCOMPLETE.inc(channel=channel_id)
+        logging.warning(
+            f"Полная сверка канала {channel_id} нашла {total_subscribers} из {expected_count} "
+            f"участников, отписки в этом цикле не записываются ({len(left_ids)} не найдено)")
+        left_ids, total_subscribers = [], expected_count
+
+    # Загрузка и сравнение идут вперемешку: время загрузки — всё остальное
+    POLL_DIFF_SECONDS.observe(diff_seconds, channel=channel_id)
+    POLL_FETCH_SECONDS.observe(
+        time.perf_counter() - started - diff_seconds, channel=channel_id)
+    return diff.new_subscribers, left_ids, total_subscribers, diff.changed_profiles
+
+
+async def fetch_incremental_diff(channel_id, stored_subscribers, admin_log_cursor):
+    """
+    Инкрементальная проверка: разбирает накопленные обновления канала и события
+    журнала действий после admin_log_cursor.
+    Возвращает (новые подписчики, id отписавшихся, всего подписчиков, новый курсор).
+    """
+    with POLL_FETCH_SECONDS.time(channel=channel_id):
+        log_events, users = await fetch_admin_log_events(channel_id, admin_log_cursor)
+
+    with POLL_DIFF_SECONDS.time(channel=channel_id):
+        # Последнее событие по каждому пользователю определяет его итоговое состояние
+        is_member = {}
+        for event in log_events:
+            change = admin_log_event_change(event)
+            if change:
+                is_member[change[0]] = change[1]
+        for uid, joined in pending_participant_updates.pop(channel_id, []):
+            is_member[uid] = joined
+
+        joined_ids = [uid for uid, member in is_member.items()
+                      if member and uid not in stored_subscribers]
+        left_ids = [uid for uid, member in is_member.items()
+                    if not member and uid in stored_subscribers]
+
+    missing = [uid for uid in joined_ids if uid not in users]
+    if missing:
+        try:
+            # Пользователи из событий известны только аккаунту, читавшему журнал
+            resolved = await (await user_pool.primary()).get_entity(missing)
+            users.update({user.id: user for user in resolved})
+        except Exception as e:
+            logging.warning(
+                f"Не удалось получить профили новых подписчиков: {e}")
+
+    new_subscribers = {uid: users.get(uid) or types.User(id=uid)
+                       for uid in joined_ids}
+    total_subscribers = len(stored_subscribers) + \
+        len(new_subscribers) - len(left_ids)
+    new_cursor = log_events[-1].id if log_events else admin_log_cursor
+    return new_subscribers, left_ids, total_subscribers, new_cursor
 
-                # Удаляем подписчика из базы данных
-                await remove_subscriber(uid)
 
-                # Логируем действие
-                await log_action(uid, username, first_name, last_name, "UNSUBSCRIBED", current_channel_id)
+async def apply_subscriber_changes(channel_id, new_subscribers, unsubscribed, total_subscribers, admin_log_cursor=None,
+                                   changed_profiles=None, cycle_checkpoint=None):
+    """
+    Сохраняет в базу найденные подписки, отписки, изменения профилей канала
+    и контрольную точку цикла одной транзакцией, затем ставит уведомления
+    о подписках и отписках в очередь отправки.
+    """
+    changed_profiles = changed_profiles or {}
+    actions = []
+    for uid, user in new_subscribers.items():
+        actions.append((uid, user.username or 'no_username', user.first_name or '',
+                        user.last_name or 'no_surname', "SUBSCRIBED"))
+    for uid, (username, first_name, last_name) in unsubscribed.items():
+        actions.append((uid, username or 'no_username', first_name or '',
+                        last_name or 'no_surname', "UNSUBSCRIBED"))
+    membership_actions = list(actions)
+    if PROFILE_TRACKING == "log":
+        for uid, user in changed_profiles.items():
+            actions.append((uid, user.username or 'no_username', user.first_name or '',
+                            user.last_name or 'no_surname', "PROFILE_CHANGED"))
+
+    with POLL_DB_WRITE_SECONDS.time(channel=channel_id):
+        await save_subscriber_diff(channel_id, new_subscribers.values(), unsubscribed.keys(),
+                                   actions, admin_log_cursor, changed_profiles.values(), cycle_checkpoint)
+    ROSTER_SIZE.set(total_subscribers, channel=channel_id)
+    cache_channel_metadata(channel_id, participants_count=total_subscribers)
+    if new_subscribers:
+        SUBSCRIBER_CHANGES.inc(len(new_subscribers),
+                               channel=channel_id, action="SUBSCRIBED")
+    if unsubscribed:
+        SUBSCRIBER_CHANGES.inc(len(unsubscribed),
+                               channel=channel_id, action="UNSUBSCRIBED")
+    if changed_profiles:
+        SUBSCRIBER_CHANGES.inc(len(changed_profiles),
+                               channel=channel_id, action="PROFILE_CHANGED")
+
+    # Запись в базу прошла — обновляем резидентный индекс
+    update_subscriber_index(
+        subscriber_index[channel_id], new_subscribers, unsubscribed.keys(), changed_profiles)
+
+    if not membership_actions or ADMIN_CHAT_ID == 0:
+        return
+
+    channel_info = tracked_channels.get(channel_id)
+    channel_username = channel_info['username'] if channel_info and channel_info['username'] else 'no_username'
+    enqueue_notifications(channel_id, channel_username,
+                          membership_actions, total_subscribers)
 
+
+async def poll_channel_once(channel_id):
+    """
+    Один цикл проверки подписчиков канала.
+    В режиме incremental полная сверка выполняется раз в RECONCILE_INTERVAL_SECONDS,
+    а в остальных циклах обрабатываются только новые события.
+    Возвращает число найденных подписок и отписок.
+    """
+    # Предыдущий список подписчиков берём из резидентного индекса
+    if channel_id not in subscriber_index:
+        subscriber_index[channel_id] = await load_subscriber_index(channel_id)
+    stored_subscribers = subscriber_index[channel_id]
+
+    new_cursor = None
+    changed_profiles = {}
+    cycle_checkpoint = None
+    full_diff = reconcile_due(channel_id)
+    if not full_diff:
+        admin_log_cursor = await get_admin_log_cursor(channel_id)
+        try:
+            new_subscribers, left_ids, total_subscribers, new_cursor = \
+                await fetch_incremental_diff(channel_id, stored_subscribers, admin_log_cursor)
+        except errors.RPCError as e:
+            # Например, нет прав администратора на чтение журнала действий
+            logging.warning(
+                f"Журнал действий канала {channel_id} недоступен, выполняется полная сверка: {e}")
+            full_diff = True
+
+    if full_diff:
+        fingerprint = None
+        if PRECHECK_MODE != "off":
+            try:
+                fingerprint = await get_roster_fingerprint(channel_id)
+            except errors.RPCError as e:
+                logging.warning(
+                    f"Предварительная проверка канала {channel_id} не удалась: {e}")
+        if fingerprint is not None and fingerprint != (None, None) and precheck_allowed(channel_id) \
+                and roster_fingerprints.get(channel_id) == fingerprint:
+            logging.debug(
+                f"Канал {channel_id} не изменился с прошлой сверки, загрузка пропущена")
+            POLL_CYCLES.inc(channel=channel_id, result="skipped")
+            return 0
+
+        pending_participant_updates.pop(channel_id, None)
+        # Курсор читается до загрузки: события во время загрузки разберёт
+        # следующий инкрементальный цикл
+        if TRACKING_MODE == "incremental":
+            try:
+                new_cursor = await get_latest_admin_log_id(channel_id)
+            except errors.RPCError as e:
+                logging.warning(
+                    f"Не удалось получить курсор журнала действий канала {channel_id}: {e}")
+        new_subscribers, left_ids, total_subscribers, changed_profiles = \
+            await fetch_full_diff(channel_id, stored_subscribers, fingerprint and fingerprint[0])
+        last_reconcile_at[channel_id] = time.monotonic()
+        # Отпечаток снят до загрузки: изменения во время загрузки попадут в следующий цикл
+        if fingerprint is not None:
+            roster_fingerprints[channel_id] = fingerprint
+        # Сохраняется вместе с результатом сверки, чтобы после перезапуска
+        # не повторять полную загрузку списка
+        cycle_checkpoint = (datetime.now(timezone.utc).isoformat(), fingerprint)
+
+    # Профили нужны только отписавшимся — для уведомлений и истории
+    unsubscribed = await get_index_profiles(channel_id, stored_subscribers, left_ids)
+    await apply_subscriber_changes(channel_id, new_subscribers, unsubscribed, total_subscribers, new_cursor,
+                                   changed_profiles, cycle_checkpoint)
+    POLL_CYCLES.inc(channel=channel_id,
+                    result="full" if full_diff else "incremental")
+    return len(new_subscribers) + len(unsubscribed)
+
+
+def get_poll_interval(channel_id):
+    """
+    Интервал опроса канала: текущий адаптивный (при ADAPTIVE_POLLING),
+    иначе собственный из таблицы channel или общий.
+    """
+    if ADAPTIVE_POLLING and channel_id in poll_intervals:
+        return poll_intervals[channel_id]
+    channel = tracked_channels.get(channel_id)
+    return (channel and channel['poll_interval']) or POLLING_INTERVAL_SECONDS
+
+
+def adapt_poll_interval(channel_id, changes=0, flood_wait=None):
+    """
+    Пересчитывает адаптивный интервал опроса канала по итогам цикла:
+    изменения сокращают интервал, пустой цикл и FloodWait — увеличивают.
+    """
+    if not ADAPTIVE_POLLING:
+        return
+    interval = get_poll_interval(channel_id)
+    if flood_wait is not None:
+        interval = max(interval * POLL_BACKOFF_FACTOR, flood_wait)
+    elif changes:
+        interval = interval / 2
+    else:
+        interval = interval * POLL_BACKOFF_FACTOR
+    interval = min(POLL_INTERVAL_MAX, max(POLL_INTERVAL_MIN, interval))
+    poll_intervals[channel_id] = interval
+    POLL_INTERVAL.set(interval, channel=channel_id)
+
+
+async def channel_poll_loop(channel_id):
+    """
+    Бесконечный цикл опроса одного канала со своим интервалом.
+    Число одновременно выполняемых циклов ограничено poll_semaphore.
+    """
+    while True:
+        waited = False
+        try:
+            if not await user_pool.authorized():
+                logging.warning(
+                    "Нет авторизованных пользовательских аккаунтов. Пропуск polling.")
+            else:
+                async with poll_semaphore:
+                    with POLL_CYCLE_SECONDS.time(channel=channel_id):
+                        changes = await poll_channel_once(channel_id)
+                    await maybe_save_roster_checkpoint(channel_id)
+                adapt_poll_interval(channel_id, changes)
+        except asyncio.CancelledError:
+            raise
+        except errors.FloodWaitError as e:
+            FLOOD_WAIT_SECONDS.inc(e.seconds, source="poll")
+            POLL_CYCLES.inc(channel=channel_id, result="flood_wait")
+            logging.warning(
+                f"FloodWait при опросе канала {channel_id}, пауза {e.seconds} с")
+            adapt_poll_interval(channel_id, flood_wait=e.seconds)
+            await asyncio.sleep(e.seconds)
+            waited = True
         except Exception as e:
-            logging.error(f"Ошибка в polling_task: {e}")
+            POLL_CYCLES.inc(channel=channel_id, result="error")
+            logging.error(f"Ошибка при опросе канала {channel_id}: {e}")
+
+        # После отсиженного FloodWait пауза уже выдержана
+        if not waited:
+            await asyncio.sleep(get_poll_interval(channel_id))
+
+
+def start_channel_polling(channel_id):
+    """Запускает (или перезапускает) задачу опроса канала."""
+    stop_channel_polling(channel_id)
+    channel_tasks[channel_id] = asyncio.create_task(
+        channel_poll_loop(channel_id))
+
+
+def stop_channel_polling(channel_id):
+    """Останавливает задачу опроса канала, если она запущена."""
+    task = channel_tasks.pop(channel_id, None)
+    if task:
+        task.cancel()
+
+
+async def polling_task():
+    """
+    Фоновая задача-планировщик: держит по одной задаче опроса на каждый
+    отслеживаемый канал и перезапускает упавшие.
+    """
+    while True:
+        for channel_id in list(channel_tasks):
+            if channel_id not in tracked_channels:
+                stop_channel_polling(channel_id)
+        for channel_id in tracked_channels:
+            task = channel_tasks.get(channel_id)
+            if task is None or task.done():
+                start_channel_polling(channel_id)
 
         await asyncio.sleep(POLLING_INTERVAL_SECONDS)
+
+# ------------------------------------------------------------------------------
+# НАЧАЛЬНЫЙ ИМПОРТ ПОДПИСЧИКОВ
+# ------------------------------------------------------------------------------
+
+
+async def import_channel_baseline(channel_id):
+    """
+    Фоновая загрузка начального списка подписчиков канала.
+    Строки пишутся пачками по IMPORT_BATCH_SIZE, каждая своей транзакцией,
+    чтобы не держать транзакцию на общем соединении во время загрузки.
+    Пока baseline_ready = 0, эти строки не используются: прерванный импорт
+    начинается заново через set_tracked_channel, который их очищает.
+    Готовность списка, контрольная точка состава и контрольная точка цикла
+    фиксируются последней транзакцией; только после этого канал попадает
+    в tracked_channels и начинает опрашиваться.
+    """
+    channel = await get_tracked_channel(channel_id)
+    title = f"{channel['name']} (@{channel['username']}) id:{channel_id}"
+
+    while not await user_pool.authorized():
+        logging.warning(
+            f"Импорт канала {channel_id} ждёт авторизации пользовательского аккаунта")
+        await asyncio.sleep(POLLING_INTERVAL_SECONDS)
+
+    builder = SubscriberIndexBuilder()
+    batch = []
+    last_report = time.monotonic()
+    try:
+        # Отпечаток и курсор журнала снимаются до загрузки, как в poll_channel_once:
+        # изменения во время импорта попадут в первый цикл опроса
+        fingerprint = None
+        if PRECHECK_MODE != "off":
+            try:
+                fingerprint = await get_roster_fingerprint(channel_id)
+            except errors.RPCError as e:
+                logging.warning(f"Предварительная проверка канала {channel_id} не удалась: {e}")
+        admin_log_cursor = None
+        if TRACKING_MODE == "incremental":
+            try:
+                admin_log_cursor = await get_latest_admin_log_id(channel_id)
+            except errors.RPCError as e:
+                logging.warning(
+                    f"Не удалось получить курсор журнала действий канала {channel_id}: {e}")
+
+        async for page in iter_participant_pages(channel_id, sharded=await use_sharded_fetch(channel_id)):
+            builder.add_page(page)
+            batch.extend(page)
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                await add_subscribers(channel_id, batch)
+                batch = []
+            if time.monotonic() - last_report >= IMPORT_PROGRESS_SECONDS:
+                last_report = time.monotonic()
+                await send_notification(
+                    f"Импорт {title}: загружено {builder.unique_count()} подписчиков...")
+        index = builder.build()
+        async with db_transaction():
+            await add_subscribers(channel_id, batch, commit=False)
+            await save_roster_checkpoint(channel_id, subscriber_index_ids(index), commit=False)
+            if admin_log_cursor is not None:
+                await set_admin_log_cursor(channel_id, admin_log_cursor, commit=False)
+            await set_cycle_checkpoint(channel_id, datetime.now(timezone.utc).isoformat(),
+                                       fingerprint, commit=False)
+            await mark_baseline_ready(channel_id, commit=False)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logging.error(f"Ошибка импорта подписчиков канала {channel_id}: {e}")
+        failed_imports[channel_id] = str(e)
+        await send_notification(f"Не удалось получить подписчиков канала {title}: {e}\n"
+                                f"Повторите /setchannel {channel_id}")
+        return
+
+    subscriber_index[channel_id] = index
+    checkpoint_cycles.pop(channel_id, None)
+    cache_channel_metadata(channel_id, participants_count=len(index))
+    # Список только что загружен — первый цикл опроса не повторяет полную загрузку
+    last_reconcile_at[channel_id] = time.monotonic()
+    if fingerprint is not None:
+        roster_fingerprints[channel_id] = fingerprint
+    tracked_channels[channel_id] = await get_tracked_channel(channel_id)
+    start_channel_polling(channel_id)
+    logging.info(f"Импорт канала {channel_id} завершён: {len(subscriber_index[channel_id])} подписчиков")
+    await send_notification(f"Установлен канал для отслеживания: {title}\n"
+                            f"Текущее количество подписчиков: {len(subscriber_index[channel_id])}")
+
+
+def start_channel_import(channel_id):
+    """Запускает фоновый импорт подписчиков канала, отменяя предыдущий."""
+    cancel_channel_import(channel_id)
+    failed_imports.pop(channel_id, None)
+    task = asyncio.create_task(import_channel_baseline(channel_id))
+    import_tasks[channel_id] = task
+    task.add_done_callback(
+        lambda done: import_tasks.pop(channel_id) if import_tasks.get(channel_id) is done else None)
+
+
+def cancel_channel_import(channel_id):
+    """Отменяет фоновый импорт подписчиков канала, если он идёт."""
+    task = import_tasks.pop(channel_id, None)
+    if task:
+        task.cancel()
+
+
+def forget_channel_state(channel_id):
+    """
+    Останавливает опрос и импорт канала и очищает всё его состояние в памяти
+    (перед повторной установкой или удалением канала).
+    """
+    stop_channel_polling(channel_id)
+    cancel_channel_import(channel_id)
+    for state in (tracked_channels, failed_imports, subscriber_index, last_reconcile_at,
+                  roster_fingerprints, poll_intervals, pending_participant_updates,
+                  checkpoint_cycles, channel_metadata):
+        state.pop(channel_id, None)
+    for key in [key for key in held_notifications if key[0] == channel_id]:
+        del held_notifications[key]
+
+# ------------------------------------------------------------------------------
+# ЭКСПОРТ ИСТОРИИ ДЕЙСТВИЙ
+# ------------------------------------------------------------------------------
+
+EXPORT_COLUMNS = ("id", "user_tg_id", "user_tg_username", "user_tg_name", "user_tg_surname",
+                  "action", "time_utc", "channel_tg_id")
+
+
+def export_format():
+    """Формат экспорта с учётом EXPORT_FORMAT и наличия pyarrow."""
+    if EXPORT_FORMAT == "parquet" and load_pyarrow() is None:
+        raise RuntimeError("Для экспорта в Parquet нужен пакет pyarrow")
+    if EXPORT_FORMAT == "auto":
+        return "parquet" if load_pyarrow() is not None else "csv"
+    return EXPORT_FORMAT
+
+
+def export_filename(date_from=None, date_to=None, fmt="csv"):
+    """Имя файла экспорта, например actions_2024-01-01_2024-01-31.csv.gz."""
+    extension = "parquet" if fmt == "parquet" else "csv.gz"
+    return f"actions_{date_from or 'start'}_{date_to or 'now'}.{extension}"
+
+
+async def iter_action_chunks(date_from=None, date_to=None):
+    """
+    Читает строки actions за период [date_from, date_to] (даты YYYY-MM-DD
+    включительно) порциями по EXPORT_CHUNK_SIZE, не загружая всю историю в память.
+    Каждая порция — отдельный короткий запрос по id: без WAL долгий курсор
+    чтения блокировал бы коммиты работающего бота.
+    """
+    conditions, params = ["id > ?"], []
+    if date_from:
+        conditions.append("time_utc >= ?")
+        params.append(date_from)
+    if date_to:
+        # time_utc — строка ISO, всё за день date_to меньше следующего дня
+        conditions.append("time_utc < ?")
+        params.append((datetime.fromisoformat(date_to) + timedelta(days=1)).date().isoformat())
+    query = f"""
+    SELECT {', '.join(EXPORT_COLUMNS)} FROM actions
+    WHERE {' AND '.join(conditions)} ORDER BY id LIMIT ?
+    """
+    last_id = 0
+    while True:
+        async with db.execute(query, (last_id, *params, EXPORT_CHUNK_SIZE)) as cursor:
+            rows = await cursor.fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        yield rows
+
+
+async def export_actions(path, date_from=None, date_to=None, fmt="csv"):
+    """
+    Потоково выгружает историю действий в файл path: gzip-CSV или Parquet.
+    Запись каждой порции выполняется в отдельном потоке. Возвращает число строк.
+    """
+    count = 0
+    if fmt == "parquet":
+        schema = pa.schema([("id", pa.int64()), ("user_tg_id", pa.int64()),
+                            ("user_tg_username", pa.string()), ("user_tg_name", pa.string()),
+                            ("user_tg_surname", pa.string()), ("action", pa.string()),
+                            ("time_utc", pa.string()), ("channel_tg_id", pa.int64())])
+        writer = pq.ParquetWriter(path, schema, compression="zstd")
+        try:
+            async for rows in iter_action_chunks(date_from, date_to):
+                table = pa.Table.from_pylist([dict(zip(EXPORT_COLUMNS, row)) for row in rows],
+                                             schema=schema)
+                await asyncio.to_thread(writer.write_table, table)
+                count += len(rows)
+        finally:
+            writer.close()
+        return count
+
+    with gzip.open(path, "wt", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(EXPORT_COLUMNS)
+        async for rows in iter_action_chunks(date_from, date_to):
+            await asyncio.to_thread(writer.writerows, rows)
+            count += len(rows)
+    return count
+
+
+async def export_cli(argv):
+    """
+    Экспорт истории без запуска бота:
+    python main.py export [--from YYYY-MM-DD] [--to YYYY-MM-DD] [--format csv|parquet] [--output PATH]
+    База открывается только для чтения, без миграций и VACUUM из init_db,
+    поэтому экспорт можно запускать рядом с работающим ботом.
+    """
+    global EXPORT_FORMAT, db
+    parser = argparse.ArgumentParser(prog="main.py export",
+                                     description="Экспорт таблицы actions в gzip-CSV или Parquet")
+    parser.add_argument("--from", dest="date_from", help="начальная дата YYYY-MM-DD")
+    parser.add_argument("--to", dest="date_to", help="конечная дата YYYY-MM-DD (включительно)")
+    parser.add_argument("--format", choices=("auto", "csv", "parquet"), default=EXPORT_FORMAT)
+    parser.add_argument("--output", help="путь к файлу (по умолчанию actions_<from>_<to>.*)")
+    args = parser.parse_args(argv)
+
+    EXPORT_FORMAT = args.format
+    try:
+        fmt = export_format()
+    except RuntimeError as e:
+        parser.error(str(e))
+    path = args.output or export_filename(args.date_from, args.date_to, fmt)
+    db = await aiosqlite.connect(pathlib.Path(DATABASE_PATH).resolve().as_uri() + "?mode=ro", uri=True)
+    try:
+        count = await export_actions(path, args.date_from, args.date_to, fmt)
+    finally:
+        await db.close()
+    logging.info(f"Выгружено {count} действий в {path}")
+
+# ------------------------------------------------------------------------------
+# ХРАНЕНИЕ И СЖАТИЕ ИСТОРИИ
+# ------------------------------------------------------------------------------
+
+
+def archive_action_rows(rows):
+    """
+    Дописывает строки actions в помесячные архивы ARCHIVE_DIR/actions_YYYY-MM.csv.gz.
+    Каждый вызов добавляет к файлу новый gzip-фрагмент; zcat и gzip.open
+    читают такие файлы целиком.
+    """
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    by_month = {}
+    for row in rows:
+        by_month.setdefault(row[6][:7], []).append(row)
+    for month, month_rows in by_month.items():
+        path = os.path.join(ARCHIVE_DIR, f"actions_{month}.csv.gz")
+        is_new = not os.path.exists(path)
+        with gzip.open(path, "at", newline="", encoding="utf-8") as file:
+            writer = csv.writer(file)
+            if is_new:
+                writer.writerow(EXPORT_COLUMNS)
+            writer.writerows(month_rows)
+
+
+async def apply_retention():
+    """
+    Переносит действия старше ACTIONS_RETENTION_DAYS суток в архив и удаляет
+    их из базы пачками, с отдельным коммитом на пачку. Пачка сначала пишется
+    в архив, поэтому при сбое до коммита строки могут попасть в архив дважды,
+    но не теряются. Возвращает число удалённых строк.
+    """
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=ACTIONS_RETENTION_DAYS)).isoformat()
+    # Сворачиваем старые контрольные точки и действия в точку на момент cutoff,
+    # чтобы состав после него по-прежнему восстанавливался
+    async with db.execute(
+            "SELECT DISTINCT channel_tg_id FROM roster_checkpoints WHERE time_utc < ?", (cutoff,)) as cursor:
+        channel_ids = [row[0] for row in await cursor.fetchall()]
+    async with db_transaction():
+        for channel_tg_id in channel_ids:
+            members = await rebuild_members(channel_tg_id, cutoff)
+            await save_roster_checkpoint(channel_tg_id, members, time_utc=cutoff, commit=False)
+        await db.execute("DELETE FROM roster_checkpoints WHERE time_utc < ?", (cutoff,))
+
+    total = 0
+    while True:
+        async with db.execute(f"""
+        SELECT {', '.join(EXPORT_COLUMNS)} FROM actions
+        WHERE time_utc < ? ORDER BY id LIMIT ?
+        """, (cutoff, RETENTION_BATCH_SIZE)) as cursor:
+            rows = await cursor.fetchall()
+        if not rows:
+            break
+        await asyncio.to_thread(archive_action_rows, rows)
+        async with db_transaction():
+            await db.execute("DELETE FROM actions WHERE id <= ? AND time_utc < ?", (rows[-1][0], cutoff))
+        total += len(rows)
+        ACTIONS_ARCHIVED.inc(len(rows))
+        # Отдаём управление циклам опроса между пачками
+        await asyncio.sleep(0)
+    return total
+
+
+async def incremental_vacuum():
+    """Возвращает свободные страницы базы шагами по VACUUM_STEP_PAGES."""
+    while True:
+        async with db.execute("PRAGMA freelist_count") as cursor:
+            free_pages = (await cursor.fetchone())[0]
+        if not free_pages:
+            break
+        # Через execute прагма освобождает лишь одну страницу за вызов,
+        # executescript выполняет её до конца шага
+        async with db_lock:
+            await db.executescript(f"PRAGMA incremental_vacuum({VACUUM_STEP_PAGES})")
+        await asyncio.sleep(0)
+
+
+async def retention_task():
+    """Фоновая задача хранения истории: архивирование, удаление и vacuum."""
+    while True:
+        try:
+            removed = await apply_retention()
+            if removed:
+                logging.info(f"Перенесено в архив {ARCHIVE_DIR} действий: {removed}")
+            await incremental_vacuum()
+        except Exception as e:
+            logging.error(f"Ошибка при очистке истории действий: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL_SECONDS)
+
 # ------------------------------------------------------------------------------
 # ПРОВЕРКА ДОСТУПА К КОМАНДАМ
 # ------------------------------------------------------------------------------
@@ -293,7 +2560,8 @@ def admin_only(func):
             logging.warning(
                 f"Команда от неавторизованного чата: {event.chat_id}")
             return
-        return await func(event)
+        with COMMAND_SECONDS.time(command=func.__name__):
+            return await func(event)
     return wrapper
 
 # ------------------------------------------------------------------------------
@@ -307,32 +2575,57 @@ async def cmd_start(event):
     text = (
         "Привет! Я бот для отслеживания подписок/отписок канала.\n\n"
         "Доступные команды:\n"
-        "/login – Войти в аккаунт (интерактивно)\n"
-        "/logout – Выйти из аккаунта\n"
-        "/status – Проверить, авторизован ли аккаунт\n"
-        "/setchannel <ID> – Установить ID канала\n"
+        "/login [new] – Войти в аккаунт (new — добавить ещё один аккаунт в пул)\n"
+        "/logout [N] – Выйти из аккаунта №N (по умолчанию основного)\n"
+        "/status – Проверить, какие аккаунты авторизованы\n"
+        "/setchannel <ID> [интервал] – Добавить канал для отслеживания\n"
+        "/removechannel <ID> – Прекратить отслеживание канала\n"
         "/getchannelid <@username> – Получить numeric ID канала по его username\n"
-        "/subcount – Узнать, сколько подписчиков\n"
-        "/viewchannel – Просмотреть текущий отслеживаемый канал\n"
+        "/subcount [ID] – Узнать, сколько подписчиков\n"
+        "/viewchannel – Просмотреть отслеживаемые каналы\n"
+        "/export [с] [по] – Выгрузить историю действий (даты YYYY-MM-DD)\n"
+        "/members_at <дата> [ID] – Состав канала на дату (YYYY-MM-DD[THH:MM])\n"
+        "/stats [период] – Подписки и отписки за период (например, 24h, 7d)\n"
+        "/metrics – Метрики циклов опроса и уведомлений\n"
         "/id – Узнать текущий chat_id (или user_id)\n"
     )
     await event.respond(text)
 
 
-@events.register(events.NewMessage(pattern=r'^/login$'))
+@events.register(events.NewMessage(pattern=r'^/login(?:\s+(new))?$'))
 @admin_only
 async def cmd_login(event):
     """
-    /login — Запрашиваем номер телефона и код для авторизации.
-    Используем conversation с ручной проверкой.
+    /login — Авторизовать первый неавторизованный аккаунт пула.
+    /login new — Добавить в пул новый аккаунт.
     """
-    global user_client
+    if event.pattern_match.group(1):
+        session_name = new_session_name()
+        client = recorded(TelegramClient(session_name, API_ID, API_HASH), session_name)
+        await client.connect()
+        if await login_conversation(event, client):
+            user_pool.add(client)
+            await add_user_session(session_name)
+            await event.respond(f"Аккаунт №{len(user_pool.clients)} добавлен в пул.")
+        else:
+            await client.disconnect()
+        return
 
-    # Если уже авторизованы
-    if user_client.is_connected() and (await user_client.is_user_authorized()):
-        await event.respond("Аккаунт уже авторизован.")
+    for client in user_pool.clients:
+        if not (client.is_connected() and await client.is_user_authorized()):
+            break
+    else:
+        # Если уже авторизованы
+        await event.respond("Все аккаунты уже авторизованы. Добавить ещё один: /login new")
         return
+    await login_conversation(event, client)
 
+
+async def login_conversation(event, client):
+    """
+    Запрашиваем номер телефона и код для авторизации аккаунта client.
+    Используем conversation с ручной проверкой. Возвращает True при успехе.
+    """
     # Начинаем "conversation"
     async with bot.conversation(event.chat_id, exclusive=False, timeout=300) as conv:
         await conv.send_message(
@@ -345,7 +2638,7 @@ async def cmd_login(event):
                 phone_event = await conv.get_response()
             except asyncio.TimeoutError:
                 await conv.send_message("Время ожидания истекло. Попробуйте заново /login.")
-                return
+                return False
 
             phone_number = phone_event.raw_text.strip()
             if phone_number.startswith('+'):
@@ -355,11 +2648,11 @@ async def cmd_login(event):
 
         try:
             # Подключаемся к клиенту
-            await user_client.connect()
+            await client.connect()
 
             # Если не авторизованы — запрашиваем код
-            if not await user_client.is_user_authorized():
-                await user_client.send_code_request(phone_number)
+            if not await client.is_user_authorized():
+                await client.send_code_request(phone_number)
                 await conv.send_message(
                     f"Код отправлен на номер {phone_number}. Введите код (только цифры):"
                 )
@@ -370,7 +2663,7 @@ async def cmd_login(event):
                         code_event = await conv.get_response()
                     except asyncio.TimeoutError:
                         await conv.send_message("Время ожидания истекло. Попробуйте заново /login.")
-                        return
+                        return False
 
                     code = code_event.raw_text.strip()
                     if code.isdigit():
@@ -380,7 +2673,7 @@ async def cmd_login(event):
 
                 # Пытаемся войти
                 try:
-                    await user_client.sign_in(phone_number, code)
+                    await client.sign_in(phone_number, code)
                     await conv.send_message("Успешно авторизовались!")
                 except errors.SessionPasswordNeededError:
                     # Если включена 2FA, просим пароль
@@ -389,87 +2682,124 @@ async def cmd_login(event):
                         pass_event = await conv.get_response()
                     except asyncio.TimeoutError:
                         await conv.send_message("Время ожидания истекло. Попробуйте заново /login.")
-                        return
+                        return False
 
                     password_2fa = pass_event.raw_text.strip()
-                    await user_client.sign_in(password=password_2fa)
+                    await client.sign_in(password=password_2fa)
                     await conv.send_message("Успешно авторизовались (с 2FA)!")
             else:
                 await conv.send_message("Уже авторизовано.")
+            return True
 
         except Exception as ex:
             await conv.send_message(f"Ошибка при авторизации: {ex}")
+            return False
 
 
-@events.register(events.NewMessage(pattern=r'^/logout$'))
+@events.register(events.NewMessage(pattern=r'^/logout(?:\s+(\d+))?$'))
 @admin_only
 async def cmd_logout(event):
     """
-    /logout — Разлогинивает аккаунт и удаляет сохранённую сессию.
+    /logout [N] — Разлогинивает аккаунт №N пула (по умолчанию основной).
+    Добавленные аккаунты при этом удаляются из пула.
     """
-    global user_client
-
-    if user_client.is_connected() and await user_client.is_user_authorized():
-        await user_client.log_out()
-        await user_client.disconnect()
-        await event.respond("Аккаунт разлогинен. Сессионный файл останется на сервере (при необходимости удалите вручную).")
+    number = int(event.pattern_match.group(1) or 1)
+    if not 1 <= number <= len(user_pool.clients):
+        await event.respond(f"Нет аккаунта №{number}. Список аккаунтов: /status")
+        return
+    client = user_pool.clients[number - 1]
+
+    if client.is_connected() and await client.is_user_authorized():
+        await client.log_out()
+        await client.disconnect()
+        if number > 1:
+            user_pool.remove(client)
+            await remove_user_session(client.session.filename)
+        await event.respond(f"Аккаунт №{number} разлогинен. Сессионный файл останется на сервере (при необходимости удалите вручную).")
     else:
-        await event.respond("Аккаунт не авторизован (или уже разлогинен).")
+        await event.respond(f"Аккаунт №{number} не авторизован (или уже разлогинен).")
 
 
 @events.register(events.NewMessage(pattern=r'^/status$'))
 @admin_only
 async def cmd_status(event):
     """
-    /status — Узнать, авторизован ли аккаунт
+    /status — Узнать, какие аккаунты пула авторизованы
     """
-    global user_client
-
-    if user_client.is_connected() and (await user_client.is_user_authorized()):
-        me = await user_client.get_me()
-        await event.respond(f"Сейчас вошли под аккаунтом: {me.first_name} (id: {me.id})")
-    else:
-        await event.respond("Сейчас аккаунт не авторизован.")
-
-
-@events.register(events.NewMessage(pattern=r'^/setchannel\s+(\-?\d+)$'))
+    lines = []
+    now = time.monotonic()
+    for number, client in enumerate(user_pool.clients, 1):
+        role = " (основной)" if client is user_client else ""
+        if client.is_connected() and (await client.is_user_authorized()):
+            me = await client.get_me()
+            line = f"{number}. {me.first_name} (id: {me.id}){role}"
+            cooldown = user_pool.cooldown_until.get(client, 0) - now
+            if cooldown > 0:
+                line += f", пауза FloodWait ещё {round(cooldown)} с"
+        else:
+            line = f"{number}. не авторизован{role}"
+        lines.append(line)
+    await event.respond("Аккаунты:\n" + "\n".join(lines))
+
+
+@events.register(events.NewMessage(pattern=r'^/setchannel\s+(\-?\d+)(?:\s+(\d+))?$'))
 @admin_only
 async def cmd_setchannel(event):
     """
-    /setchannel <ID> — Устанавливаем канал, за которым следим
+    /setchannel <ID> [интервал] — Добавляем канал, за которым следим.
+    Необязательный интервал задаёт период опроса канала в секундах.
     """
-    global current_channel_id
     channel_id = event.pattern_match.group(1)
+    poll_interval = event.pattern_match.group(2)
     try:
         channel_id = int(channel_id)
+        poll_interval = int(poll_interval) if poll_interval else None
     except ValueError:
         await event.respond("Неверный формат ID канала. Убедитесь, что вы ввели числовой ID.")
         return
 
     try:
         # Получаем информацию о канале
-        channel_entity = await user_client.get_entity(channel_id)
+        channel_entity = await user_pool.call("get_entity", channel_id)
         channel_name = channel_entity.title or 'no_title'
         channel_username = channel_entity.username or 'no_username'
     except Exception as e:
         await event.respond(f"Не удалось получить информацию о канале: {e}")
         return
 
+    # Пока сохраняется начальный список подписчиков, канал не опрашивается.
+    # Первый цикл по каналу выполнит полную сверку и выставит курсор
+    forget_channel_state(channel_id)
+
     # Устанавливаем канал для отслеживания
-    await set_tracked_channel(channel_id, channel_name, channel_username)
-    current_channel_id = channel_id
+    await set_tracked_channel(channel_id, channel_name, channel_username, poll_interval)
+    cache_channel_metadata(channel_id, title=channel_entity.title, username=channel_entity.username)
     logging.info(
         f"Установлен канал для отслеживания: {channel_name} (@{channel_username}) id:{channel_id}")
 
-    # Получаем текущих подписчиков и сохраняем их в базе
-    try:
-        participants = await user_client.get_participants(channel_id)
-        for user in participants:
-            await add_subscriber(user)
-        await event.respond(f"Установлен канал для отслеживания: {channel_name} (@{channel_username}) id:{channel_id}\n"
-                            f"Текущее количество подписчиков: {len(participants)}")
-    except Exception as e:
-        await event.respond(f"Не удалось получить подписчиков канала: {e}")
+    # Подписчиков загружаем в фоне, о ходе импорта сообщит import_channel_baseline
+    start_channel_import(channel_id)
+    await event.respond(f"Канал {channel_name} (@{channel_username}) id:{channel_id} добавлен.\n"
+                        f"Начат импорт подписчиков, опрос начнётся после его завершения.")
+
+
+@events.register(events.NewMessage(pattern=r'^/removechannel\s+(\-?\d+)$'))
+@admin_only
+async def cmd_removechannel(event):
+    """
+    /removechannel <ID> — Прекратить отслеживание канала
+    """
+    channel_id = int(event.pattern_match.group(1))
+    # Канал может быть ещё в процессе начального импорта
+    channel_info = await get_tracked_channel(channel_id)
+    if channel_info is None:
+        await event.respond(f"Канал id:{channel_id} не отслеживается.")
+        return
+
+    forget_channel_state(channel_id)
+    await remove_tracked_channel(channel_id)
+    logging.info(f"Канал id:{channel_id} удалён из отслеживаемых")
+    await event.respond(f"Канал {channel_info['name']} (@{channel_info['username']}) id:{channel_id} больше не отслеживается.")
 
 
 @events.register(events.NewMessage(pattern=r'^/getchannelid\s+(@\S+)$'))
@@ -478,40 +2808,56 @@ async def cmd_getchannelid(event):
     """
     /getchannelid <@username> — Получить numeric ID канала по его @username
     """
-    global user_client
-
-    if not user_client.is_connected() or not (await user_client.is_user_authorized()):
+    if not await user_pool.authorized():
         await event.respond("Сначала нужно авторизоваться (команда /login).")
         return
 
     username = event.pattern_match.group(1)
     try:
-        entity = await user_client.get_entity(username)
+        entity = await user_pool.call("get_entity", username)
         await event.respond(f"ID для {username} = {entity.id}")
     except Exception as e:
         await event.respond(f"Не удалось получить ID: {e}")
 
 
-@events.register(events.NewMessage(pattern=r'^/subcount$'))
+async def resolve_channel_arg(event, channel_arg):
+    """
+    Определяет канал для команды: явно переданный ID или единственный
+    отслеживаемый канал. Если канал определить нельзя, отвечает и возвращает None.
+    """
+    if channel_arg:
+        channel_id = int(channel_arg)
+        if channel_id not in tracked_channels:
+            await event.respond(f"Канал id:{channel_id} не отслеживается.")
+            return None
+        return channel_id
+    if not tracked_channels:
+        await event.respond("Сначала установите канал /setchannel <ID>.")
+        return None
+    if len(tracked_channels) > 1:
+        await event.respond("Отслеживается несколько каналов, укажите ID канала.")
+        return None
+    return next(iter(tracked_channels))
+
+
+@events.register(events.NewMessage(pattern=r'^/subcount(?:\s+(\-?\d+))?$'))
 @admin_only
 async def cmd_subcount(event):
     """
-    /subcount — Узнать количество подписчиков (через аккаунт)
+    /subcount [ID] — Узнать количество подписчиков (через аккаунт)
     """
-    global user_client, current_channel_id
-
-    if current_channel_id is None:
-        await event.respond("Сначала установите канал /setchannel <ID>.")
+    channel_id = await resolve_channel_arg(event, event.pattern_match.group(1))
+    if channel_id is None:
         return
 
-    if not user_client.is_connected() or not (await user_client.is_user_authorized()):
+    # Свежие данные из кэша не требуют обращения к Telegram
+    if cached_channel_metadata(channel_id) is None and not await user_pool.authorized():
         await event.respond("Сначала нужно авторизоваться (команда /login).")
         return
 
     try:
-        participants = await user_client.get_participants(current_channel_id)
-        count = len(participants)
-        await event.respond(f"Сейчас в канале {count} подписчиков.")
+        metadata = await get_channel_metadata(channel_id)
+        await event.respond(f"Сейчас в канале {metadata['participants_count']} подписчиков.")
     except Exception as e:
         await event.respond(f"Ошибка при получении количества подписчиков: {e}")
 
@@ -520,19 +2866,165 @@ async def cmd_subcount(event):
 @admin_only
 async def cmd_viewchannel(event):
     """
-    /viewchannel — Просмотреть текущий отслеживаемый канал
+    /viewchannel — Просмотреть отслеживаемые каналы
     """
-    channel_info = await get_tracked_channel()
-    if channel_info:
-        channel_username = channel_info['username'] or 'no_channel_username'
-        channel_name = channel_info['name'] or 'no_title'
-        channel_id = channel_info['tg_id']
-        msg = f"{channel_name} @{channel_username} id:{channel_id}"
-        await event.respond(msg)
+    # Ответ собирается из памяти: опрашиваемые каналы, идущие и неудавшиеся импорты
+    lines = []
+    for channel_id in dict.fromkeys((*tracked_channels, *import_tasks, *failed_imports)):
+        channel_info = tracked_channels.get(channel_id)
+        if channel_info:
+            channel_name, channel_username = channel_info['name'], channel_info['username']
+            state = f"интервал {get_poll_interval(channel_id)} с"
+            metadata = cached_channel_metadata(channel_id)
+            if metadata:
+                state += f", {metadata['participants_count']} подписчиков"
+        else:
+            metadata = channel_metadata.get(channel_id, {})
+            channel_name, channel_username = metadata.get('title'), metadata.get('username')
+            if channel_id in import_tasks:
+                state = "идёт импорт подписчиков"
+            else:
+                state = f"импорт не завершён, повторите /setchannel {channel_id}"
+        lines.append(f"{channel_name or 'no_title'} @{channel_username or 'no_channel_username'} "
+                     f"id:{channel_id} ({state})")
+    if lines:
+        await event.respond("\n".join(lines))
     else:
         await event.respond("Нет установленного канала для отслеживания. Используйте /setchannel <ID>.")
 
 
+@events.register(events.NewMessage(pattern=r'^/stats(?:\s+(\d+)([hd]))?$'))
+@admin_only
+async def cmd_stats(event):
+    """
+    /stats [период] — Подписки, отписки и чистый прирост по каналам за период:
+    Nh — последние N часов, Nd — последние N суток (по умолчанию 7d).
+    """
+    period = int(event.pattern_match.group(1) or 7)
+    unit = event.pattern_match.group(2) or "d"
+    if period < 1:
+        await event.respond("Период должен быть не меньше 1.")
+        return
+
+    stats = await get_action_stats(period, unit)
+    if not stats:
+        await event.respond(f"За {period}{unit} подписок и отписок не было.")
+        return
+
+    lines = [f"Статистика за {period}{unit}:"]
+    for channel_id, (subscribed, unsubscribed) in stats.items():
+        channel_info = tracked_channels.get(channel_id)
+        name = channel_info['name'] if channel_info else f"id:{channel_id}"
+        line = f"{name}: +{subscribed} / -{unsubscribed}, итого {subscribed - unsubscribed:+d}"
+        # Отток — доля отписавшихся от числа подписчиков в начале периода
+        if channel_id in subscriber_index:
+            start_count = len(subscriber_index[channel_id]) - (subscribed - unsubscribed)
+            if start_count > 0:
+                line += f", отток {unsubscribed / start_count:.2%}"
+        lines.append(line)
+    await event.respond("\n".join(lines))
+
+
+@events.register(events.NewMessage(
+    pattern=r'^/export(?:\s+(\d{4}-\d{2}-\d{2}))?(?:\s+(\d{4}-\d{2}-\d{2}))?$'))
+@admin_only
+async def cmd_export(event):
+    """
+    /export [с] [по] — Выгрузить историю действий за период файлом
+    (gzip-CSV или Parquet, если установлен pyarrow).
+    """
+    date_from, date_to = event.pattern_match.group(1), event.pattern_match.group(2)
+    try:
+        fmt = export_format()
+        for date in (date_from, date_to):
+            if date:
+                datetime.fromisoformat(date)
+    except (RuntimeError, ValueError) as e:
+        await event.respond(f"Не удалось выполнить экспорт: {e}")
+        return
+
+    filename = export_filename(date_from, date_to, fmt)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, filename)
+        try:
+            count = await export_actions(path, date_from, date_to, fmt)
+            await bot.send_file(event.chat_id, path, caption=f"Выгружено действий: {count}",
+                                force_document=True)
+        except Exception as e:
+            logging.error(f"Ошибка экспорта истории действий: {e}")
+            await event.respond(f"Не удалось выполнить экспорт: {e}")
+
+
+@events.register(events.NewMessage(pattern=r'^/members_at\s+(\S+)(?:\s+(\-?\d+))?$'))
+@admin_only
+async def cmd_members_at(event):
+    """
+    /members_at <дата> [ID] — Состав канала на указанный момент (UTC):
+    число подписчиков и файл с их id.
+    """
+    channel_id = await resolve_channel_arg(event, event.pattern_match.group(2))
+    if channel_id is None:
+        return
+    try:
+        moment = datetime.fromisoformat(event.pattern_match.group(1))
+    except ValueError:
+        await event.respond("Неверный формат даты. Пример: 2024-01-31 или 2024-01-31T12:00")
+        return
+
+    members = await get_members_at(channel_id, moment)
+    if members is None:
+        await event.respond("Нет данных о составе канала на этот момент.")
+        return
+
+    still_subscribed = len(members) - len(sorted_difference(
+        members, subscriber_index_ids(subscriber_index[channel_id])))
+    caption = (f"На {event.pattern_match.group(1)} в канале было {len(members)} подписчиков, "
+               f"из них сейчас подписаны {still_subscribed}.")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, f"members_{channel_id}_{moment:%Y%m%d_%H%M%S}.txt")
+        with open(path, "w") as file:
+            file.writelines(f"{uid}\n" for uid in members)
+        await bot.send_file(event.chat_id, path, caption=caption, force_document=True)
+
+
+def histogram_summary(histogram, **labels):
+    """Краткая сводка гистограммы для /metrics: число, среднее и p95."""
+    state = histogram.values.get(tuple(sorted(labels.items())))
+    if not state or not state[-1]:
+        return "нет данных"
+    return (f"n={state[-1]}, среднее {state[-2] / state[-1]:.3f} с, "
+            f"p95 ≤ {histogram.quantile(0.95, **labels)} с")
+
+
+@events.register(events.NewMessage(pattern=r'^/metrics$'))
+@admin_only
+async def cmd_metrics(event):
+    """
+    /metrics — Сводка метрик циклов опроса и уведомлений
+    """
+    lines = []
+    for channel_id in tracked_channels:
+        roster_size = ROSTER_SIZE.values.get((("channel", channel_id),), "?")
+        lines.append(f"Канал id:{channel_id}, подписчиков: {roster_size}")
+        lines.append(
+            f"  цикл: {histogram_summary(POLL_CYCLE_SECONDS, channel=channel_id)}")
+        lines.append(
+            f"  загрузка: {histogram_summary(POLL_FETCH_SECONDS, channel=channel_id)}")
+        lines.append(
+            f"  сравнение: {histogram_summary(POLL_DIFF_SECONDS, channel=channel_id)}")
+        lines.append(
+            f"  запись в базу: {histogram_summary(POLL_DB_WRITE_SECONDS, channel=channel_id)}")
+    flood_wait = {dict(labels)['source']: value for labels,
+                  value in FLOOD_WAIT_SECONDS.values.items()}
+    lines.append(
+        f"Очередь уведомлений: {NOTIFICATION_QUEUE_DEPTH.function()}")
+    lines.append(
+        f"Отправлено уведомлений: {NOTIFICATIONS_SENT.values.get((), 0)}")
+    lines.append(f"FloodWait, с: опрос {flood_wait.get('poll', 0)}, "
+                 f"уведомления {flood_wait.get('notify', 0)}")
+    await event.respond("\n".join(lines))
+
+
 @events.register(events.NewMessage(pattern=r'^/id$'))
 async def cmd_id(event):
     """
@@ -554,10 +3046,13 @@ async def shutdown():
     logging.info("Начинается процесс завершения работы...")
     if bot:
         await bot.disconnect()
-    if user_client:
-        await user_client.disconnect()
+    if user_pool:
+        for client in user_pool.clients:
+            await client.disconnect()
     if db:
         await db.close()
+    if traffic_recorder:
+        traffic_recorder.close()
     logging.info("Работа завершена.")
     sys.exit(0)  # Завершаем процесс
 
@@ -574,13 +3069,30 @@ async def main():
     bot.add_event_handler(cmd_logout)
     bot.add_event_handler(cmd_status)
     bot.add_event_handler(cmd_setchannel)
+    bot.add_event_handler(cmd_removechannel)
     bot.add_event_handler(cmd_getchannelid)
     bot.add_event_handler(cmd_subcount)
     bot.add_event_handler(cmd_viewchannel)
+    bot.add_event_handler(cmd_stats)
+    bot.add_event_handler(cmd_members_at)
+    bot.add_event_handler(cmd_export)
+    bot.add_event_handler(cmd_metrics)
     bot.add_event_handler(cmd_id)
 
-    # Запускаем фоновую задачу polling
+    # Обновления об участниках канала для инкрементального режима
+    if TRACKING_MODE == "incremental":
+        user_client.add_event_handler(
+            on_channel_participant_update, events.Raw(types.UpdateChannelParticipant))
+
+    # HTTP-эндпоинт метрик (если задан METRICS_PORT)
+    await start_metrics_server()
+
+    # Запускаем фоновые задачи polling и отправки уведомлений
     polling = asyncio.create_task(polling_task())
+    notifier = asyncio.create_task(notification_task())
+    background = [polling, notifier]
+    if ACTIONS_RETENTION_DAYS:
+        background.append(asyncio.create_task(retention_task()))
 
     # Обработка сигналов для корректного завершения
     loop = asyncio.get_running_loop()
@@ -590,10 +3102,17 @@ async def main():
 
     # Работаем вечно
     logging.info("Бот и пользовательский клиент запущены и ждут событий...")
-    await asyncio.gather(polling)
+    await asyncio.gather(*background)
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["export"]:
+        asyncio.run(export_cli(sys.argv[2:]))
+        sys.exit(0)
     try:
         asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
         logging.info("Бот остановлен пользователем.")
+    finally:
+        # Без закрытия файл записи остаётся без конца потока gzip
+        if traffic_recorder:
+            traffic_recorder.close()
@@ -0,0 +1,580 @@
+"""
+Запись и воспроизведение обращений к Telegram для нагрузочных прогонов.
+
+TrafficRecorder оборачивает клиенты main.py (бота и аккаунты пула): каждый
+вызов get_entity, get_participants, iter_participants, сырого запроса
+client(...), send_message и т. п., а также обновления events.Raw пишутся
+в сжатый файл (gzip, JSON Lines) — смещение от начала записи, длительность,
+метод, ключ аргументов, ответ или ошибка. Объекты TL хранятся в бинарной
+сериализации Telegram (base64). Запись включается в main.py переменной
+TG_RECORD_PATH.
+
+TrafficPlayer и ReplayClient отдают записанные ответы и ошибки (в том числе
+FloodWait) с исходными задержками при скорости 1x, ускоренно или без задержек
+(--speed 0), а драйвер прогоняет на них циклы опроса, запись в базу и отправку
+уведомлений main.py без обращения к настоящему Telegram.
+
+Пример:
+    TG_RECORD_PATH=traffic.jsonl.gz python main.py
+    python replay.py traffic.jsonl.gz --db copy_of_telegram_bot.db --speed 10
+    python replay.py traffic.jsonl.gz --db copy.db --speed 0 --profile replay.prof
+
+Ответ подбирается по клиенту, методу и ключу аргументов; если такого вызова
+в записи нет (например, база отличается от той, что была при записи), берётся
+следующий записанный вызов того же метода — такие подмены считаются в отчёте.
+Прогон изменяет переданную базу, поэтому воспроизводить следует на копии.
+"""
+import argparse
+import asyncio
+import base64
+import builtins
+import collections
+import cProfile
+import functools
+import gzip
+import itertools
+import json
+import logging
+import os
+import sys
+import time
+import types as pytypes
+import zlib
+
+from telethon import errors, events, types
+from telethon.extensions import BinaryReader
+from telethon.helpers import TotalList
+from telethon.tl.tlobject import TLObject
+
+# Записываемые методы клиента (кроме client(...) и iter_participants)
+RECORDED_METHODS = ("get_entity", "get_input_entity", "get_participants", "get_dialogs",
+                    "get_me", "send_message", "send_file")
+# Исходящие сообщения при воспроизведении могут отличаться от записанных:
+# если записи не хватило, вызов просто завершается без ответа
+LENIENT_METHODS = ("send_message", "send_file")
+# Как часто сбрасывать буфер файла записи на диск, с
+FLUSH_INTERVAL_SECONDS = 1.0
+# Выдача iter_participants записывается частями по столько пользователей
+RECORD_CHUNK_SIZE = 1000
+
+
+class ReplayExhausted(Exception):
+    """В записи не осталось ответов на вызов метода."""
+
+
+def encode_value(value):
+    """Ответ клиента в JSON-совместимом виде."""
+    if isinstance(value, TLObject):
+        return {"tl": base64.b64encode(bytes(value)).decode()}
+    if isinstance(value, (list, tuple)):
+        data = {"list": [encode_value(item) for item in value]}
+        if isinstance(value, TotalList):
+            data["total"] = value.total
+        return data
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return {"v": value}
+    # Прочие объекты (например, диалоги) main.py не использует — хранится только repr
+    return {"repr": repr(value)}
+
+
+def decode_value(data):
+    """Восстанавливает ответ, сохранённый encode_value."""
+    if "tl" in data:
+        return BinaryReader(base64.b64decode(data["tl"])).tgread_object()
+    if "list" in data:
+        items = [decode_value(item) for item in data["list"]]
+        if "total" in data:
+            result = TotalList(items)
+            result.total = data["total"]
+            return result
+        return items
+    return data.get("v")
+
+
+def encode_error(error):
+    """Исключение клиента в JSON-совместимом виде."""
+    data = {"type": type(error).__name__, "message": str(error)}
+    if isinstance(error, errors.RPCError):
+        data["message"] = error.message
+        data["code"] = error.code
+    if isinstance(error, errors.FloodWaitError):
+        data["seconds"] = error.seconds
+    return data
+
+
+def decode_error(data, speed=1):
+    """
+    Восстанавливает исключение, сохранённое encode_error.
+    Пауза FloodWait при ускоренном воспроизведении сокращается в speed раз.
+    """
+    if data["type"] == "FloodWaitError":
+        seconds = round(data["seconds"] / speed) if speed else 0
+        return errors.FloodWaitError(request=None, capture=seconds)
+    cls = getattr(errors, data["type"], None)
+    if isinstance(cls, type) and issubclass(cls, errors.RPCError):
+        try:
+            return cls(request=None)
+        except TypeError:
+            pass
+    cls = getattr(builtins, data["type"], None)
+    if isinstance(cls, type) and issubclass(cls, Exception):
+        return cls(data["message"])
+    return errors.RPCError(None, data["message"], data.get("code"))
+
+
+def key_part(value):
+    """Стабильное строковое представление аргумента для ключа вызова."""
+    if isinstance(value, TLObject):
+        return bytes(value).hex()
+    if isinstance(value, (list, tuple)):
+        return "[" + ",".join(key_part(item) for item in value) + "]"
+    return repr(value)
+
+
+def call_key(method, args, kwargs):
+    """Ключ вызова: crc32 метода и его аргументов."""
+    parts = [method] + [key_part(arg) for arg in args] + \
+        [f"{name}={key_part(value)}" for name, value in sorted(kwargs.items())]
+    return format(zlib.crc32("\x00".join(parts).encode()), "08x")
+
+# ------------------------------------------------------------------------------
+# ЗАПИСЬ
+# ------------------------------------------------------------------------------
+
+
+class TrafficRecorder:
+    """Файл записи обращений к Telegram; клиенты оборачиваются через wrap."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = gzip.open(path, "wt", encoding="utf-8")
+        self.started = time.monotonic()
+        self.last_flush = self.started
+        self.records = 0
+        self.call_ids = itertools.count(1)
+
+    def wrap(self, client, label):
+        """Возвращает клиент, все обращения которого записываются под меткой label."""
+        self.write(label, "client")
+        return RecordingClient(client, self, label)
+
+    def write(self, label, method, key="", started=None, duration=0.0, result=None, error=None,
+              call_id=None, part=False):
+        """
+        Добавляет запись о вызове (или обновлении) в файл. Выдача
+        iter_participants пишется несколькими записями с общим call_id:
+        первая — как обычный вызов, остальные — продолжения (part).
+        """
+        started = time.monotonic() if started is None else started
+        record = {"t": round(started - self.started, 4), "d": round(duration, 4),
+                  "c": label, "m": method}
+        if key:
+            record["k"] = key
+        if call_id is not None:
+            record["i"] = call_id
+        if part:
+            record["p"] = 1
+        if result is not None:
+            record["r"] = encode_value(result)
+        if error is not None:
+            record["e"] = encode_error(error)
+        self.file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self.records += 1
+        now = time.monotonic()
+        if now - self.last_flush >= FLUSH_INTERVAL_SECONDS:
+            self.file.flush()
+            self.last_flush = now
+
+    def close(self):
+        """Сбрасывает буфер и закрывает файл записи."""
+        if not self.file.closed:
+            self.file.close()
+            logging.info(f"Запись обращений к Telegram сохранена: {self.path} ({self.records} записей)")
+
+
+class RecordingClient:
+    """
+    Обёртка над TelegramClient: записываемые методы проходят через
+    TrafficRecorder, остальные атрибуты берутся у исходного клиента.
+    """
+
+    def __init__(self, client, recorder, label):
+        self._client = client
+        self._recorder = recorder
+        self._label = label
+
+    def __getattr__(self, name):
+        if name in RECORDED_METHODS:
+            return functools.partial(self._record, name, getattr(self._client, name))
+        return getattr(self._client, name)
+
+    async def __call__(self, request, *args, **kwargs):
+        return await self._record("call", self._client, request, *args, **kwargs)
+
+    async def _record(self, method, function, *args, **kwargs):
+        key = call_key(method, args, kwargs)
+        started = time.monotonic()
+        try:
+            result = await function(*args, **kwargs)
+        except Exception as e:
+            self._recorder.write(self._label, method, key, started, time.monotonic() - started, error=e)
+            raise
+        self._recorder.write(self._label, method, key, started, time.monotonic() - started, result=result)
+        return result
+
+    async def iter_participants(self, *args, **kwargs):
+        """
+        iter_participants; выдача записывается частями по RECORD_CHUNK_SIZE
+        пользователей, чтобы не держать весь список в памяти.
+        """
+        key = call_key("iter_participants", args, kwargs)
+        call_id = next(self._recorder.call_ids)
+        started = time.monotonic()
+        part = False
+        users = []
+        error = None
+
+        def write_chunk():
+            nonlocal started, part, users
+            self._recorder.write(self._label, "iter_participants", key, started,
+                                 time.monotonic() - started, result=users, error=error,
+                                 call_id=call_id, part=part)
+            started, part, users = time.monotonic(), True, []
+
+        try:
+            async for user in self._client.iter_participants(*args, **kwargs):
+                users.append(user)
+                yield user
+                if len(users) >= RECORD_CHUNK_SIZE:
+                    write_chunk()
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            write_chunk()
+
+    def add_event_handler(self, callback, event=None):
+        """Обработчики events.Raw получают обновления через запись."""
+        if not isinstance(event, events.Raw):
+            return self._client.add_event_handler(callback, event)
+
+        async def recording_callback(update):
+            self._recorder.write(self._label, "update", result=update)
+            return await callback(update)
+
+        return self._client.add_event_handler(recording_callback, event)
+
+# ------------------------------------------------------------------------------
+# ВОСПРОИЗВЕДЕНИЕ
+# ------------------------------------------------------------------------------
+
+
+def read_records(path):
+    """
+    Читает записи из файла TrafficRecorder. Файл, оборванный аварийным
+    завершением процесса (без конца потока gzip), читается до последней
+    целой строки.
+    """
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    pending = b""
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            try:
+                pending += decompressor.decompress(chunk)
+            except zlib.error:
+                break
+            *lines, pending = pending.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    yield json.loads(line)
+            if decompressor.eof:
+                break
+    if not decompressor.eof:
+        logging.warning(f"Запись {path} оборвана, воспроизводится до последней целой строки")
+
+
+class TrafficPlayer:
+    """
+    Записанные обращения, разложенные по клиенту и методу. Ответы выдаются
+    не раньше их исходного смещения от начала записи, делённого на speed,
+    и с записанной длительностью вызова (speed=0 — без задержек).
+    """
+
+    def __init__(self, records, speed=1.0):
+        self.speed = speed
+        self.labels = []  # метки клиентов в порядке подключения
+        self.updates = []
+        self.by_key = collections.defaultdict(collections.deque)
+        self.by_method = collections.defaultdict(collections.deque)
+        self.handlers = collections.defaultdict(list)
+        self.parts = collections.defaultdict(list)  # call_id -> продолжения выдачи
+        self.span = 0.0
+        self.calls = 0
+        self.substituted = 0
+        self.missing = 0
+        for record in records:
+            self.span = max(self.span, record["t"] + record["d"])
+            if record["m"] == "client":
+                if record["c"] not in self.labels:
+                    self.labels.append(record["c"])
+            elif record["m"] == "update":
+                self.updates.append(record)
+            elif record.get("p"):
+                self.parts[record["i"]].append(record)
+            else:
+                record["used"] = False
+                self.by_key[record["c"], record["m"], record.get("k")].append(record)
+                self.by_method[record["c"], record["m"]].append(record)
+        self.started = None
+
+    @classmethod
+    def load(cls, path, speed=1.0):
+        """Читает файл записи TrafficRecorder."""
+        return cls(read_records(path), speed)
+
+    def client(self, label):
+        """ReplayClient для клиента с меткой label."""
+        return ReplayClient(self, label)
+
+    def take(self, label, method, key):
+        """Следующая неиспользованная запись вызова: сначала с тем же ключом, затем любая того же метода."""
+        queue = self.by_key.get((label, method, key))
+        while queue and queue[0]["used"]:
+            queue.popleft()
+        if queue:
+            record = queue.popleft()
+        else:
+            queue = self.by_method.get((label, method))
+            while queue and queue[0]["used"]:
+                queue.popleft()
+            if not queue:
+                raise ReplayExhausted(f"{label}.{method}")
+            record = queue.popleft()
+            self.substituted += 1
+        record["used"] = True
+        return record
+
+    async def wait_until(self, offset):
+        """Ждёт момента offset записи с учётом скорости воспроизведения."""
+        if not self.speed:
+            return
+        loop = asyncio.get_running_loop()
+        if self.started is None:
+            self.started = loop.time()
+        delay = self.started + offset / self.speed - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def play(self, record):
+        """
+        Выдерживает время записи и возвращает (ответ, ошибка). Ответ вместе
+        с ошибкой бывает у iter_participants — частичная выдача перед ошибкой.
+        """
+        await self.wait_until(record["t"])
+        if self.speed:
+            await asyncio.sleep(record["d"] / self.speed)
+        result = decode_value(record["r"]) if "r" in record else None
+        error = decode_error(record["e"], self.speed) if "e" in record else None
+        return result, error
+
+    async def replay(self, label, method, key):
+        """Записанный результат вызова: (ответ, ошибка)."""
+        try:
+            record = self.take(label, method, key)
+        except ReplayExhausted:
+            if method in LENIENT_METHODS:
+                self.missing += 1
+                return None, None
+            raise
+        self.calls += 1
+        return await self.play(record)
+
+    async def replay_pages(self, label, key):
+        """Записанная выдача iter_participants частями: (пользователи, ошибка)."""
+        record = self.take(label, "iter_participants", key)
+        self.calls += 1
+        yield await self.play(record)
+        for part in self.parts.get(record.get("i"), ()):
+            yield await self.play(part)
+
+    async def dispatch_updates(self):
+        """Передаёт записанные обновления обработчикам events.Raw в исходном темпе."""
+        for record in self.updates:
+            await self.wait_until(record["t"])
+            update = decode_value(record["r"])
+            for callback in self.handlers[record["c"]]:
+                await callback(update)
+
+
+class ReplayClient:
+    """Замена TelegramClient, отвечающая записями TrafficPlayer."""
+
+    def __init__(self, player, label):
+        self._player = player
+        self._label = label
+        self.session = pytypes.SimpleNamespace(filename=label)
+
+    def __getattr__(self, name):
+        if name in RECORDED_METHODS:
+            async def replay_method(*args, **kwargs):
+                result, error = await self._player.replay(self._label, name, call_key(name, args, kwargs))
+                if error is not None:
+                    raise error
+                return result
+            return replay_method
+        raise AttributeError(name)
+
+    async def __call__(self, request, *args, **kwargs):
+        result, error = await self._player.replay(
+            self._label, "call", call_key("call", (request,) + args, kwargs))
+        if error is not None:
+            raise error
+        return result
+
+    async def iter_participants(self, *args, **kwargs):
+        async for users, error in self._player.replay_pages(
+                self._label, call_key("iter_participants", args, kwargs)):
+            for user in users or ():
+                yield user
+            if error is not None:
+                raise error
+
+    def is_connected(self):
+        return True
+
+    async def is_user_authorized(self):
+        return True
+
+    async def connect(self):
+        pass
+
+    async def disconnect(self):
+        pass
+
+    def add_event_handler(self, callback, event=None):
+        if isinstance(event, events.Raw):
+            self._player.handlers[self._label].append(callback)
+
+# ------------------------------------------------------------------------------
+# ДРАЙВЕР
+# ------------------------------------------------------------------------------
+
+
+async def replay_channel(main, player, channel_id):
+    """
+    Циклы опроса канала подряд, пока в записи есть ответы; темп задают
+    смещения записанных вызовов. Повторяет обработку ошибок channel_poll_loop.
+    """
+    while True:
+        calls = player.calls
+        try:
+            async with main.poll_semaphore:
+                with main.POLL_CYCLE_SECONDS.time(channel=channel_id):
+                    await main.poll_channel_once(channel_id)
+                await main.maybe_save_roster_checkpoint(channel_id)
+        except ReplayExhausted:
+            return
+        except errors.FloodWaitError as e:
+            main.FLOOD_WAIT_SECONDS.inc(e.seconds, source="poll")
+            main.POLL_CYCLES.inc(channel=channel_id, result="flood_wait")
+            logging.warning(f"FloodWait при опросе канала {channel_id}, пауза {e.seconds} с")
+            await asyncio.sleep(e.seconds)
+        except Exception as e:
+            main.POLL_CYCLES.inc(channel=channel_id, result="error")
+            logging.error(f"Ошибка при опросе канала {channel_id}: {e}")
+        if player.calls == calls:
+            # Цикл не обратился к записи — повтор дал бы тот же результат
+            return
+
+
+async def wait_notifications_idle(main):
+    """Ждёт, пока очередь уведомлений опустеет и отправка остановится."""
+    window = main.NOTIFY_COALESCE_SECONDS + 1 / main.notify_bucket.rate + 0.1
+    while True:
+        sent = main.NOTIFICATIONS_SENT.values.get((), 0)
+        await asyncio.sleep(window)
+        if main.notification_queue.empty() and not main.held_notifications \
+                and main.NOTIFICATIONS_SENT.values.get((), 0) == sent:
+            return
+
+
+async def run_replay(path, database_path, speed):
+    """Воспроизводит запись на базе database_path и возвращает отчёт."""
+    import main
+
+    player = TrafficPlayer.load(path, speed)
+    main.DATABASE_PATH = database_path
+    # Без ADMIN_CHAT_ID уведомления не формируются — отправка всё равно идёт в ReplayClient
+    main.ADMIN_CHAT_ID = main.ADMIN_CHAT_ID or -1
+    main.bot = player.client("bot")
+    main.user_pool = main.ClientPool(
+        [player.client(label) for label in player.labels if label != "bot"])
+    main.user_client = main.user_pool.clients[0]
+    main.poll_semaphore = asyncio.Semaphore(main.MAX_CONCURRENT_POLLS)
+    main.notification_queue = asyncio.Queue()
+    # Ограничение частоты уведомлений ускоряется вместе с записью
+    notify_rate = main.NOTIFY_RATE_PER_SECOND * speed if speed else 1e9
+    main.notify_bucket = main.TokenBucket(notify_rate, main.NOTIFY_BURST)
+    await main.init_db()
+    await main.load_tracked_channels()
+    if main.TRACKING_MODE == "incremental":
+        main.user_client.add_event_handler(
+            main.on_channel_participant_update, events.Raw(types.UpdateChannelParticipant))
+
+    started = time.perf_counter()
+    notifier = asyncio.create_task(main.notification_task())
+    updates = asyncio.create_task(player.dispatch_updates())
+    await asyncio.gather(*(replay_channel(main, player, channel_id)
+                           for channel_id in list(main.tracked_channels)))
+    updates.cancel()
+    await wait_notifications_idle(main)
+    notifier.cancel()
+    wall = time.perf_counter() - started
+    await main.db.close()
+
+    def totals(metric, label):
+        result = collections.Counter()
+        for key, value in metric.values.items():
+            result[dict(key).get(label)] += value
+        return dict(result)
+
+    return {
+        "recorded_span_s": round(player.span, 3),
+        "wall_s": round(wall, 3),
+        "speed": speed,
+        "calls": player.calls,
+        "substituted_calls": player.substituted,
+        "unrecorded_messages": player.missing,
+        "poll_cycles": totals(main.POLL_CYCLES, "result"),
+        "subscriber_changes": totals(main.SUBSCRIBER_CHANGES, "action"),
+        "notifications_sent": main.NOTIFICATIONS_SENT.values.get((), 0),
+        "flood_wait_s": totals(main.FLOOD_WAIT_SECONDS, "source"),
+    }
+
+
+def replay_cli(argv=None):
+    """Точка входа: python replay.py <запись> --db <копия базы> [--speed N]."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recording", help="файл записи (TG_RECORD_PATH)")
+    parser.add_argument("--db", required=True,
+                        help="база, на которой воспроизводится запись (изменяется)")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="скорость воспроизведения: 1 — исходный темп, 0 — без задержек")
+    parser.add_argument("--profile", help="сохранить профиль cProfile в файл")
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.db):
+        parser.error(f"База {args.db} не найдена")
+
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    report = asyncio.run(run_replay(args.recording, args.db, args.speed))
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    replay_cli(sys.argv[1:])